@@ -3,54 +3,987 @@ from functools import partial
 from io import BytesIO
 from tkinter import *
 from tkinter import messagebox
+from tkinter.ttk import Progressbar
 import sys
 import os
-from PIL import Image, ImageTk
+import re
+import time
+import hashlib
+import sqlite3
+import tempfile
+import shutil
+import threading
+import socket
+import heapq
+import itertools
+import importlib
+import inspect
+import atexit
+import logging
+import unicodedata
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager, nullcontext
 from enum import Enum
-import requests
-from requests.exceptions import ConnectionError, RequestException, ConnectTimeout
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from queue import Queue, Empty, Full
+from collections import deque
 import random
+import json
+import csv
 from tkinterdnd2 import DND_FILES, DND_TEXT
 
 
-__all__ = ["ScrolledFrame", "ImageSearch"]
+__all__ = ["URLFrontier", "HTTPClient", "ImageCache", "QueryCache", "CachedURLScrapper", "ImageStore", "HammingIndex",
+           "FetchBackend", "ThreadFetchBackend", "AsyncioFetchBackend", "URLSource", "FetchMetrics", "HostHealth",
+           "RetryScheduler", "AdaptiveConcurrency", "DecodeProcessPool", "ScrolledFrame", "ImageFetcher", "ImageSearch",
+           "BatchImageSearch", "preload_modules"]
 
 
-class Deque:
+class _LazyModule:
+    """
+    Module that is imported on first attribute access.
+    Network and imaging modules take most of the import time, so they are loaded only when they are used
+    or in the background by preload_modules, and the window can be shown before they are ready
+    """
+    instances = []
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        _LazyModule.instances.append(self)
+
+    def load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)  # import lock makes it safe to race
+        return self._module
+
+    @property
+    def loaded(self) -> bool:
+        return self._module is not None
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+    def __repr__(self):
+        return f"_LazyModule({self._name!r}, loaded={self._module is not None})"
+
+
+asyncio = _LazyModule("asyncio")
+Image = _LazyModule("PIL.Image")
+ImageTk = _LazyModule("PIL.ImageTk")
+ImageChops = _LazyModule("PIL.ImageChops")
+requests = _LazyModule("requests")
+
+logger = logging.getLogger(__name__)
+
+
+def preload_modules():
+    """
+    imports lazily loaded modules on a background thread, so that they are ready by the first fetch
+    without delaying the first paint of the window
+    :return: started thread, None if everything is loaded
+    """
+    def load():
+        for module in _LazyModule.instances:
+            module.load()
+        _counting_http_adapter_class()
+
+    if all(module.loaded for module in _LazyModule.instances) and _counting_http_adapter is not None:
+        return None
+    thread = threading.Thread(target=load, name="preload_modules", daemon=True)
+    thread.start()
+    return thread
+
+
+class URLFrontier:
+    """
+    Queue of urls waiting to be fetched.
+    Every url is remembered on insertion, so the same url is never queued twice
+    during the lifetime of the frontier (use requeue() to put back a url that has to be retried).
+    """
     def __init__(self, collection=None):
         """
         :param collection: iterable
         """
-        self.deque = collection if collection is not None else []
+        self._queue = deque()
+        self._seen = set()
+        self.duplicate_hits = 0
+        if collection is not None:
+            self.extend(collection)
 
     def __len__(self):
-        return len(self.deque)
+        return len(self._queue)
 
     def __bool__(self):
-        return bool(self.deque)
+        return bool(self._queue)
+
+    def __contains__(self, url):
+        return url in self._seen
+
+    def _register(self, url) -> bool:
+        if url in self._seen:
+            self.duplicate_hits += 1
+            return False
+        self._seen.add(url)
+        return True
 
     def pop(self, n=1) -> list:
-        return [self.deque.pop() for _ in range(min(n, len(self.deque)))]
+        return [self._queue.pop() for _ in range(min(n, len(self._queue)))]
 
     def popleft(self, n=1) -> list:
-        return [self.deque.pop(0) for _ in range(min(n, len(self.deque)))]
+        return [self._queue.popleft() for _ in range(min(n, len(self._queue)))]
+
+    def append(self, url) -> bool:
+        """
+        :return: whether url was queued (False for already seen urls)
+        """
+        if self._register(url):
+            self._queue.append(url)
+            return True
+        return False
+
+    def add_seen(self, url) -> bool:
+        """
+        remembers url that is fetched without being queued
+        :return: whether url wasn't seen before
+        """
+        return self._register(url)
+
+    def appendleft(self, url) -> bool:
+        if self._register(url):
+            self._queue.appendleft(url)
+            return True
+        return False
+
+    def extend(self, collection) -> int:
+        """
+        :return: number of queued urls
+        """
+        return sum(self.append(url) for url in collection)
 
-    def append(self, item):
-        self.deque.append(item)
+    def extendleft(self, collection) -> int:
+        """
+        keeps the order of the given collection
+        """
+        fresh = [url for url in collection if self._register(url)]
+        self._queue.extendleft(reversed(fresh))
+        return len(fresh)
 
-    def appendleft(self, item):
-        self.deque.insert(0, item)
+    def requeue(self, url, left=False):
+        """
+        puts already seen url back into the queue bypassing deduplication (retries)
+        """
+        self._seen.add(url)
+        if left:
+            self._queue.appendleft(url)
+        else:
+            self._queue.append(url)
 
-    def extend(self, collection):
-        self.deque.extend(collection)
+    @property
+    def n_seen(self):
+        return len(self._seen)
 
-    def extendleft(self, collection):
-        for i in range(len(collection)-1, -1, -1):
-            self.appendleft(collection[i])
+    def stats(self) -> dict:
+        return {"size": len(self._queue),
+                "seen": len(self._seen),
+                "duplicate_hits": self.duplicate_hits}
 
     def __repr__(self):
-        return f"Deque {self.deque}"
+        return f"URLFrontier(size={len(self._queue)}, seen={len(self._seen)}, duplicate_hits={self.duplicate_hits})"
+
+
+def _write_atomic(path, data: bytes):
+    """
+    writes data to a temporary file in the same directory and moves it in place,
+    so concurrent readers never see partially written files
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class URLSource:
+    """
+    Runs url_scrapper on a background thread and buffers the urls it produces until they are taken.
+    url_scrapper(query) may return a list or any other iterable (e.g. a generator), an async iterator,
+    a coroutine returning any of these, or a paged callback: a function that returns the next page of urls
+    on every call and an empty page when there are no more.
+    Scrapper is advanced only while the buffer has room, so urls are scrapped as they are needed
+    """
+    _END = object()
+
+    def __init__(self, url_scrapper, query, buffer_size=100):
+        self.url_scrapper = url_scrapper
+        self.query = query
+        self.error = None
+        self._buffer = Queue(maxsize=buffer_size)
+        self._closed = threading.Event()
+        self._finished = False
+        self._error_taken = False
+        self._thread = threading.Thread(target=self._run, name="URLSource", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    @staticmethod
+    def iterate(result):
+        """
+        :param result: url_scrapper result
+        :return: iterator of urls
+        """
+        if inspect.iscoroutine(result):
+            result = asyncio.run(result)
+        if hasattr(result, "__aiter__"):
+            loop = asyncio.new_event_loop()
+            iterator = result.__aiter__()
+            try:
+                while True:
+                    try:
+                        yield loop.run_until_complete(iterator.__anext__())
+                    except StopAsyncIteration:
+                        return
+            finally:
+                loop.run_until_complete(loop.shutdown_asyncgens())
+                loop.close()
+        elif callable(result):
+            while True:
+                page = result()
+                if not page:
+                    return
+                yield from page
+        else:
+            yield from result
+
+    def _put(self, item) -> bool:
+        while not self._closed.is_set():
+            try:
+                self._buffer.put(item, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def _run(self):
+        try:
+            for url in self.iterate(self.url_scrapper(self.query)):
+                if not self._put(url):
+                    return
+        except Exception as e:
+            self.error = e
+        self._put(URLSource._END)
+
+    def take(self, n) -> list:
+        """
+        :return: up to n already scrapped urls. Doesn't wait for the scrapper
+        """
+        urls = []
+        while len(urls) < n and not self._finished:
+            try:
+                url = self._buffer.get_nowait()
+            except Empty:
+                break
+            if url is URLSource._END:
+                self._finished = True
+            else:
+                urls.append(url)
+        return urls
+
+    @property
+    def exhausted(self) -> bool:
+        """
+        whether all urls of the scrapper were taken
+        """
+        if not self._finished and self._buffer.queue and self._buffer.queue[0] is URLSource._END:
+            self.take(1)
+        return self._finished
+
+    def take_error(self):
+        """
+        :return: exception raised by the scrapper. Returned only once
+        """
+        if self.error is None or self._error_taken:
+            return None
+        self._error_taken = True
+        return self.error
+
+    def close(self):
+        """
+        stops the scrapper as soon as it produces the next url
+        """
+        self._closed.set()
+
+
+_counting_http_adapter = None
+_counting_http_adapter_lock = threading.Lock()
+
+
+def _counting_http_adapter_class():
+    """
+    :return: HTTPAdapter subclass that reports every connection established by its pools (including
+        reconnections) with the time it took to connect, and hands over the connection of every request
+        once it is connected. Created on first use, as it needs requests and urllib3
+    """
+    global _counting_http_adapter
+    with _counting_http_adapter_lock:
+        if _counting_http_adapter is not None:
+            return _counting_http_adapter
+        from requests.adapters import HTTPAdapter
+        from urllib3.connection import HTTPConnection, HTTPSConnection
+        from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+        class CountingHTTPAdapter(HTTPAdapter):
+            def __init__(self, on_new_connection, on_connection=None, **kwargs):
+                self._on_new_connection = on_new_connection
+                self._on_connection = on_connection if on_connection is not None else lambda connection: None
+                super(CountingHTTPAdapter, self).__init__(**kwargs)
+
+            def init_poolmanager(self, *args, **kwargs):
+                super(CountingHTTPAdapter, self).init_poolmanager(*args, **kwargs)
+                on_new_connection = self._on_new_connection
+                on_connection = self._on_connection
+
+                class CountingHTTPConnection(HTTPConnection):
+                    def connect(self):
+                        start = time.perf_counter()
+                        try:
+                            super(CountingHTTPConnection, self).connect()
+                        finally:
+                            on_new_connection(time.perf_counter() - start)
+                        on_connection(self)
+
+                    def request(self, *args, **kwargs):
+                        # plain http connections are established inside of the request
+                        on_connection(self)
+                        return super(CountingHTTPConnection, self).request(*args, **kwargs)
+
+                class CountingHTTPSConnection(HTTPSConnection):
+                    def connect(self):
+                        start = time.perf_counter()
+                        try:
+                            super(CountingHTTPSConnection, self).connect()
+                        finally:
+                            on_new_connection(time.perf_counter() - start)
+                        on_connection(self)
+
+                    def request(self, *args, **kwargs):
+                        on_connection(self)
+                        return super(CountingHTTPSConnection, self).request(*args, **kwargs)
+
+                class CountingHTTPConnectionPool(HTTPConnectionPool):
+                    ConnectionCls = CountingHTTPConnection
+
+                class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+                    ConnectionCls = CountingHTTPSConnection
+
+                self.poolmanager.pool_classes_by_scheme = {"http": CountingHTTPConnectionPool,
+                                                           "https": CountingHTTPSConnectionPool}
+
+        _counting_http_adapter = CountingHTTPAdapter
+        return _counting_http_adapter
+
+
+class _RequestAborter:
+    """
+    aborts request running on another thread by shutting down the socket of its connection.
+    Socket is never closed here: the requesting thread gets an error and drops the connection itself
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._connection = None
+        self.aborted = False
+
+    def attach(self, connection):
+        with self._lock:
+            self._connection = connection
+            if self.aborted:
+                self._shutdown()
+
+    def detach(self):
+        with self._lock:
+            self._connection = None
+
+    def abort(self):
+        with self._lock:
+            self.aborted = True
+            self._shutdown()
+
+    def _shutdown(self):
+        sock = getattr(self._connection, "sock", None)
+        if sock is None:  # not connected yet, shut down by attach right after connecting
+            return
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class HTTPClient:
+    """
+    requests session with keep-alive connection pools shared by all fetches.
+    Number of simultaneous requests is limited both globally and per host.
+    Session is created by the first request
+    """
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(self, max_connections=32, max_connections_per_host=6, retries=0, backoff_factor=0.1):
+        """
+        :param max_connections: maximum number of simultaneous requests
+        :param max_connections_per_host: maximum number of simultaneous requests to one host
+        :param retries: how many times failed connections and 502/503/504 responses are retried
+        :param backoff_factor: delay factor between retries
+        """
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self._global_slots = threading.BoundedSemaphore(max_connections)
+        self._host_slots = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.n_requests = 0
+        self.n_new_connections = 0
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self._session = None
+
+    @property
+    def session(self):
+        if self._session is not None:
+            return self._session
+        with self._lock:
+            if self._session is None:
+                from urllib3.util.retry import Retry
+                retry = Retry(total=self.retries, read=False, backoff_factor=self.backoff_factor,
+                              status_forcelist=(502, 503, 504), raise_on_status=False)
+                adapter = _counting_http_adapter_class()(self._count_new_connection, self._attach_connection,
+                                                         pool_connections=self.max_connections,
+                                                         pool_maxsize=self.max_connections_per_host,
+                                                         max_retries=retry)
+                self._session = requests.Session()
+                self._session.mount("http://", adapter)
+                self._session.mount("https://", adapter)
+            return self._session
+
+    @classmethod
+    def default(cls):
+        """
+        :return: process-wide client used by windows that don't configure their own
+        """
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = cls()
+            return cls._default
+
+    def _count_new_connection(self, connect_time):
+        with self._lock:
+            self.n_new_connections += 1
+        # connections are established on the thread of the request
+        self._local.connect_time = getattr(self._local, "connect_time", 0.0) + connect_time
+
+    def _attach_connection(self, connection):
+        aborter = getattr(self._local, "aborter", None)
+        if aborter is not None:
+            aborter.attach(connection)
+
+    def _host_semaphore(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            semaphore = self._host_slots.get(host)
+            if semaphore is None:
+                semaphore = self._host_slots[host] = threading.BoundedSemaphore(self.max_connections_per_host)
+            return semaphore
+
+    @contextmanager
+    def stream(self, url, token=None, **kwargs):
+        """
+        performs streamed GET request. Connection slots are held until the context is left.
+        Connection of a response whose body wasn't read to the end is dropped instead of being reused.
+        Response gets wait_time (for connection slots) and connect_time attributes, in seconds
+        :param token: CancellationToken. Cancelling it from another thread shuts down the socket of the request,
+            so waiting for the headers or for the next chunk fails at once and the connection is dropped
+        :param kwargs: requests.Session.get parameters
+        """
+        wait_start = time.perf_counter()
+        with self._host_semaphore(url), self._global_slots:
+            wait_time = time.perf_counter() - wait_start
+            with self._lock:
+                self.n_requests += 1
+            self._local.connect_time = 0.0
+            aborter = _RequestAborter()
+            with token.on_cancel(aborter.abort) if token is not None else nullcontext():
+                self._local.aborter = aborter
+                try:
+                    response = self.session.get(url, stream=True, **kwargs)
+                finally:
+                    self._local.aborter = None
+                response.wait_time = wait_time
+                response.connect_time = self._local.connect_time
+                try:
+                    yield response
+                finally:
+                    # connection goes back to the pool on close, it mustn't be shut down after that
+                    aborter.detach()
+                    response.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            n_reused = max(self.n_requests - self.n_new_connections, 0)
+            return {"requests": self.n_requests,
+                    "new_connections": self.n_new_connections,
+                    "reused_connections": n_reused,
+                    "reuse_ratio": n_reused / self.n_requests if self.n_requests else 0.0}
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+
+
+class CacheEntry(namedtuple("CacheEntry", ["content", "content_hash", "etag", "last_modified", "expires_at"])):
+    @property
+    def is_fresh(self):
+        return self.expires_at > time.time()
+
+    def validators(self) -> dict:
+        """
+        :return: headers of the conditional request that revalidates this entry
+        """
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class ImageCache:
+    """
+    Persistent content-addressed cache of fetched image bytes and of their display thumbnails.
+    Urls point to blobs named after sha256 of their content, so mirrors of one picture are stored once.
+    Index lives in sqlite, which makes one cache directory safe to share between threads, windows and processes.
+    """
+    _MAX_AGE_RE = re.compile(r"max-age\s*=\s*(\d+)")
+
+    def __init__(self, cache_dir, max_bytes=256 * 2 ** 20, ttl=24 * 60 * 60):
+        """
+        :param cache_dir: cache directory. Created if missing
+        :param max_bytes: cache size budget. Least recently used entries are evicted when it is exceeded
+        :param ttl: seconds an entry is used without revalidation when response has no max-age
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._local = threading.local()
+        self._counters_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.evictions = 0
+
+        os.makedirs(cache_dir, exist_ok=True)
+        conn = self._connection()
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS urls (
+                url TEXT PRIMARY KEY,
+                content_hash TEXT NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                expires_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS entries_last_access ON entries(last_access);
+        """)
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(os.path.join(self.cache_dir, "index.sqlite"), timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _count(self, counter):
+        with self._counters_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    @staticmethod
+    def content_key(content: bytes) -> str:
+        return hashlib.sha256(content).hexdigest()
+
+    @staticmethod
+    def thumbnail_key(content_hash, width, height) -> str:
+        return f"{content_hash}_{width or 0}x{height or 0}.png"
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def _read(self, key):
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+        except OSError:
+            self._connection().execute("DELETE FROM entries WHERE key = ?", (key,))
+            return None
+        self._connection().execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+        return data
+
+    def _write(self, key, data: bytes):
+        _write_atomic(self._path(key), data)
+        self._connection().execute("INSERT OR REPLACE INTO entries (key, size, last_access) VALUES (?, ?, ?)",
+                                   (key, len(data), time.time()))
+        self._evict()
+
+    def _evict(self):
+        conn = self._connection()
+        total_size = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total_size <= self.max_bytes:
+            return
+        for key, size in conn.execute("SELECT key, size FROM entries ORDER BY last_access").fetchall():
+            if total_size <= self.max_bytes:
+                break
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+            total_size -= size
+            self._count("evictions")
+
+    def _expiration(self, headers) -> float:
+        cache_control = headers.get("Cache-Control", "").lower()
+        if "no-cache" in cache_control:
+            return 0
+        max_age = self._MAX_AGE_RE.search(cache_control)
+        return time.time() + (int(max_age.group(1)) if max_age is not None else self.ttl)
+
+    def lookup(self, url):
+        """
+        :return: CacheEntry or None
+        """
+        row = self._connection().execute(
+            "SELECT content_hash, etag, last_modified, expires_at FROM urls WHERE url = ?", (url,)).fetchone()
+        content = self._read(row[0]) if row is not None else None
+        if content is None:
+            self._count("misses")
+            return None
+        self._count("hits")
+        return CacheEntry(content, *row)
+
+    def store(self, url, content: bytes, headers) -> str:
+        """
+        :param headers: response headers
+        :return: content hash
+        """
+        content_hash = self.content_key(content)
+        if "no-store" in headers.get("Cache-Control", "").lower():
+            return content_hash
+        if not os.path.exists(self._path(content_hash)):
+            self._write(content_hash, content)
+        self._connection().execute(
+            "INSERT OR REPLACE INTO urls (url, content_hash, etag, last_modified, expires_at) VALUES (?, ?, ?, ?, ?)",
+            (url, content_hash, headers.get("ETag"), headers.get("Last-Modified"), self._expiration(headers)))
+        return content_hash
+
+    def refresh(self, url, headers):
+        """
+        extends lifetime of the entry after successful revalidation (304 Not Modified)
+        """
+        self._count("revalidations")
+        self._connection().execute("UPDATE urls SET expires_at = ?, etag = COALESCE(?, etag) WHERE url = ?",
+                                   (self._expiration(headers), headers.get("ETag"), url))
+
+    def get_thumbnail(self, content_hash, width, height):
+        """
+        :return: encoded thumbnail or None
+        """
+        return self._read(self.thumbnail_key(content_hash, width, height))
+
+    def store_thumbnail(self, content_hash, width, height, thumbnail):
+        buffer = BytesIO()
+        thumbnail.save(buffer, format="PNG")
+        self._write(self.thumbnail_key(content_hash, width, height), buffer.getvalue())
+
+    def size(self) -> int:
+        return self._connection().execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def stats(self) -> dict:
+        return {"size": self.size(),
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "revalidations": self.revalidations,
+                "evictions": self.evictions}
+
+
+class QueryEntry(namedtuple("QueryEntry", ["urls", "complete", "expires_at"])):
+    @property
+    def is_fresh(self):
+        return self.expires_at > time.time()
+
+
+class QueryCache:
+    """
+    Persistent cache of url lists of search queries and of the state of their windows (shown pages, scroll
+    position, chosen images). Queries are normalized, so "Cats" and " cats " share one entry.
+    Index lives in sqlite like the one of ImageCache, and both can share one cache directory
+    """
+    def __init__(self, cache_dir, ttl=60 * 60):
+        """
+        :param cache_dir: cache directory. Created if missing
+        :param ttl: seconds url list of a query is used without scrapping it again
+        """
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self._local = threading.local()
+        self._counters_lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._connection().executescript("""
+            CREATE TABLE IF NOT EXISTS queries (
+                query TEXT PRIMARY KEY,
+                urls TEXT NOT NULL,
+                complete INTEGER NOT NULL,
+                expires_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS query_states (
+                query TEXT PRIMARY KEY,
+                state TEXT NOT NULL
+            );
+        """)
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(os.path.join(self.cache_dir, "queries.sqlite"), timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _count(self, counter):
+        with self._counters_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    @staticmethod
+    def normalize(query) -> str:
+        """
+        :return: case-folded query with collapsed whitespace
+        """
+        return " ".join(unicodedata.normalize("NFKC", query).casefold().split())
+
+    def lookup(self, query):
+        """
+        :return: QueryEntry or None
+        """
+        row = self._connection().execute("SELECT urls, complete, expires_at FROM queries WHERE query = ?",
+                                         (self.normalize(query),)).fetchone()
+        if row is None:
+            self._count("misses")
+            return None
+        entry = QueryEntry(json.loads(row[0]), bool(row[1]), row[2])
+        self._count("hits" if entry.is_fresh else "stale_hits")
+        return entry
+
+    def store(self, query, urls, complete=True):
+        """
+        :param complete: whether urls are all urls of the query or only the ones scrapped so far
+        """
+        self._connection().execute(
+            "INSERT OR REPLACE INTO queries (query, urls, complete, expires_at) VALUES (?, ?, ?, ?)",
+            (self.normalize(query), json.dumps(list(urls)), int(complete), time.time() + self.ttl))
+
+    def load_state(self, query):
+        """
+        :return: dict saved by save_state or None
+        """
+        row = self._connection().execute("SELECT state FROM query_states WHERE query = ?",
+                                         (self.normalize(query),)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def save_state(self, query, state: dict):
+        self._connection().execute("INSERT OR REPLACE INTO query_states (query, state) VALUES (?, ?)",
+                                   (self.normalize(query), json.dumps(state)))
+
+    def stats(self) -> dict:
+        return {"queries": self._connection().execute("SELECT COUNT(*) FROM queries").fetchone()[0],
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses}
+
+
+class CachedURLScrapper:
+    """
+    url_scrapper that answers from QueryCache. Fresh url lists are returned without calling the scrapper.
+    Stale ones are returned as well, while the scrapper refreshes them on a background thread.
+    Urls of missing queries are passed through as they are scrapped and cached as they come, so that
+    the next lookup gets at least the urls that were taken. Lists that don't hold all urls of the query
+    are continued by the scrapper once they are used up
+    """
+    def __init__(self, url_scrapper, query_cache: QueryCache):
+        """
+        :param url_scrapper: anything URLSource accepts
+        """
+        self.url_scrapper = url_scrapper
+        self.query_cache = query_cache
+        self.refreshes = 0
+        self.refresh_errors = 0
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def __call__(self, query):
+        entry = self.query_cache.lookup(query)
+        if entry is None:
+            return self.scrape(query)
+        if not entry.is_fresh:
+            self.refresh(query, None if entry.complete else len(entry.urls))
+        if entry.complete:
+            return entry.urls
+        return itertools.chain(entry.urls, self.scrape(query, entry.urls))
+
+    def scrape(self, query, cached_urls=()):
+        """
+        yields urls of the scrapper. They are cached when the scrapper is finished or abandoned
+        :param cached_urls: urls of an incomplete entry. They aren't yielded again and are replaced
+            only by a longer list
+        """
+        cached = set(cached_urls)
+        urls = []
+        complete = False
+        try:
+            for url in URLSource.iterate(self.url_scrapper(query)):
+                urls.append(url)
+                if url not in cached:
+                    yield url
+            complete = True
+        finally:
+            if complete or len(urls) > len(cached):
+                self.query_cache.store(query, urls, complete)
+
+    def refresh(self, query, max_urls=None):
+        """
+        scrapes the query again on a background thread. Only one refresh of a query runs at a time
+        :param max_urls: stop after this many urls, None to scrape all of them
+        """
+        key = QueryCache.normalize(query)
+        with self._lock:
+            if key in self._refreshing:
+                return None
+            self._refreshing.add(key)
+            self.refreshes += 1
+        thread = threading.Thread(target=self._refresh, args=(key, query, max_urls), name="QueryCache refresh",
+                                  daemon=True)
+        thread.start()
+        return thread
+
+    def _refresh(self, key, query, max_urls):
+        try:
+            urls = list(itertools.islice(URLSource.iterate(self.url_scrapper(query)), max_urls))
+            if urls:  # failed scrapper doesn't replace stale urls
+                self.query_cache.store(query, urls, complete=max_urls is None or len(urls) < max_urls)
+        except Exception:
+            with self._lock:
+                self.refresh_errors += 1
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+
+class ImageStore:
+    """
+    Keeps source images of the shown results without decoding them.
+    Only compressed bytes are held in memory. When max_bytes is exceeded, the least recently added
+    images are spilled to temporary files. Images are decoded only when opened for saving
+    """
+    def __init__(self, max_bytes=64 * 2 ** 20):
+        """
+        :param max_bytes: memory budget for compressed image bytes
+        """
+        self.max_bytes = max_bytes
+        self.resident_bytes = 0
+        self.evictions = 0
+        self._images = []  # bytes or path to the file with the image
+        self._resident = OrderedDict()  # index -> size of in-memory images
+        self._spill_dir = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._images)
+
+    def add(self, content: bytes = None, path=None) -> int:
+        """
+        stores either image bytes or a reference to an image file
+        :return: index of stored image
+        """
+        with self._lock:
+            index = len(self._images)
+            if content is None:
+                self._images.append(path)
+                return index
+            self._images.append(content)
+            self._resident[index] = len(content)
+            self.resident_bytes += len(content)
+            while self.resident_bytes > self.max_bytes and len(self._resident) > 1:
+                self._spill(*self._resident.popitem(last=False))
+            return index
+
+    def _spill(self, index, size):
+        if self._spill_dir is None:
+            self._spill_dir = tempfile.mkdtemp(prefix="ImageSearch_")
+        path = os.path.join(self._spill_dir, str(index))
+        with open(path, "wb") as f:
+            f.write(self._images[index])
+        self._images[index] = path
+        self.resident_bytes -= size
+        self.evictions += 1
+
+    def get_bytes(self, index) -> bytes:
+        with self._lock:
+            source = self._images[index]
+        if isinstance(source, bytes):
+            return source
+        with open(source, "rb") as f:
+            return f.read()
+
+    def open(self, index):
+        """
+        decodes stored image in full resolution
+        """
+        with self._lock:
+            source = self._images[index]
+        img = Image.open(BytesIO(source) if isinstance(source, bytes) else source)
+        img.load()
+        return img
+
+    def clear(self):
+        with self._lock:
+            self._images = []
+            self._resident = OrderedDict()
+            self.resident_bytes = 0
+            if self._spill_dir is not None:
+                shutil.rmtree(self._spill_dir, ignore_errors=True)
+                self._spill_dir = None
+
+    def stats(self) -> dict:
+        return {"images": len(self._images),
+                "resident_bytes": self.resident_bytes,
+                "max_bytes": self.max_bytes,
+                "evictions": self.evictions}
 
 
 class ScrolledFrame(Frame):
@@ -78,6 +1011,8 @@ class ScrolledFrame(Frame):
         sf = ScrolledFrame(self)
         sf.pack()
         sf.display_widget(Label, text="Hello, world!")
+    Use display_virtual_grid() to display a long grid of equally sized
+    cells whose widgets are created only near the viewport.
     The constructor accepts the usual Tkinter keyword arguments, plus
     a handful of its own:
       scrollbars (str; default: "both")
@@ -100,6 +1035,11 @@ class ScrolledFrame(Frame):
         # Whether to fit the interior widget's width to the canvas
         self._fit_width = False
 
+        # Virtual grid state (see display_virtual_grid())
+        self._virtual_grid = False
+        self._virtual_cells = {}
+        self._free_virtual_cells = []
+
         # Which scrollbars to provide
         if "scrollbars" in kw:
             scrollbars = kw["scrollbars"]
@@ -144,7 +1084,7 @@ class ScrolledFrame(Frame):
         ys = self._y_scrollbar = Scrollbar(self,
                                            orient="vertical",
                                            command=c.yview)
-        c.configure(xscrollcommand=xs.set, yscrollcommand=ys.set)
+        c.configure(xscrollcommand=xs.set, yscrollcommand=self._on_yscroll)
 
         # Lay out our widgets
         c.grid(row=0, column=0, sticky="nsew")
@@ -263,16 +1203,83 @@ class ScrolledFrame(Frame):
 
         return self._interior
 
+    def display_virtual_grid(self, n_columns, cell_width, cell_height,
+                             create_cell, configure_cell, release_cell=None,
+                             show_cell=None, padx=0, pady=0, overscan=1, **kw):
+        """Create and display a virtual grid of equally sized cells.
+        Widgets exist only for the rows inside the viewport (plus
+        `overscan` rows above and below it) and are recycled while
+        scrolling:
+          create_cell(master) returns a new cell widget,
+          configure_cell(widget, index) shows cell `index` in the widget,
+          release_cell(widget) is called when the widget leaves the view,
+          show_cell(index) returns False for cells left empty.
+        The grid is empty until set_virtual_grid(n_cells=...) is called.
+        Keyword arguments are passed to the interior Frame constructor.
+        Returns the interior frame.
+        """
+
+        interior = self.display_widget(Frame, **kw)
+
+        self._virtual_grid = True
+        self._n_columns = n_columns
+        self._cell_width = cell_width
+        self._cell_height = cell_height
+        self._cell_padx = padx
+        self._cell_pady = pady
+        self._overscan = overscan
+        self._create_cell = create_cell
+        self._configure_cell = configure_cell
+        self._release_cell = release_cell
+        self._show_cell = show_cell
+        self._n_cells = 0
+
+        self._resize_virtual_grid()
+        return interior
+
+    def set_virtual_grid(self, n_cells=None, cell_width=None, cell_height=None):
+        """Change the number of cells or the cell size of the virtual grid."""
+
+        if n_cells is not None:
+            self._n_cells = n_cells
+        if cell_width is not None or cell_height is not None:
+            self._cell_width = cell_width or self._cell_width
+            self._cell_height = cell_height or self._cell_height
+            for index, widget in self._virtual_cells.items():
+                self._place_cell(widget, index)
+        self._resize_virtual_grid()
+
+    def refresh_virtual_grid(self, index=None):
+        """Show the current content of cell `index` (or of every
+        displayed cell) in its widget."""
+
+        if index is None:
+            # Cells may have been emptied or filled
+            self._update_virtual_cells()
+            for index, widget in self._virtual_cells.items():
+                self._configure_cell(widget, index)
+        elif index in self._virtual_cells and self._is_cell_shown(index):
+            self._configure_cell(self._virtual_cells[index], index)
+        else:
+            self._update_virtual_cells()
+
     def erase(self):
         """Erase the displayed widget."""
 
         # Clear the canvas
         self._canvas.delete("all")
 
-        # Delete the interior widget
+        # Destroy the interior widget along with its children
+        if self._interior is not None:
+            self._interior.destroy()
         del self._interior
         del self._interior_id
 
+        # Forget the virtual grid
+        self._virtual_grid = False
+        self._virtual_cells = {}
+        self._free_virtual_cells = []
+
         # Save these names
         self._interior = None
         self._interior_id = None
@@ -324,6 +1331,62 @@ class ScrolledFrame(Frame):
             # Windows
             c.yview_scroll(-1 * (event.delta // 120), "units")
 
+    def _on_yscroll(self, first, last):
+        """Update the scrollbar and the virtual grid when the view changes."""
+
+        self._y_scrollbar.set(first, last)
+        if self._virtual_grid:
+            self._update_virtual_cells()
+
+    def _resize_virtual_grid(self):
+        """Fit the interior frame to the virtual grid."""
+
+        n_rows = -(-self._n_cells // self._n_columns)
+        self._interior.configure(width=max(self._n_columns * self._cell_width, 1),
+                                 height=max(n_rows * self._cell_height, 1))
+        self._update_virtual_cells()
+
+    def _place_cell(self, widget, index):
+        row, column = divmod(index, self._n_columns)
+        widget.place(x=column * self._cell_width + self._cell_padx,
+                     y=row * self._cell_height + self._cell_pady,
+                     width=self._cell_width - 2 * self._cell_padx,
+                     height=self._cell_height - 2 * self._cell_pady)
+
+    def _is_cell_shown(self, index):
+        return self._show_cell is None or self._show_cell(index)
+
+    def _update_virtual_cells(self):
+        """Recycle widgets of the cells that left the view or were
+        emptied and create widgets for the cells that entered it."""
+
+        c = self._canvas
+        top = c.canvasy(0)
+        bottom = top + c.winfo_height()
+        first_row = max(int(top // self._cell_height) - self._overscan, 0)
+        last_row = int(bottom // self._cell_height) + self._overscan
+        visible = {index for index in range(first_row * self._n_columns,
+                                            min((last_row + 1) * self._n_columns, self._n_cells))
+                   if self._is_cell_shown(index)}
+
+        for index in [i for i in self._virtual_cells if i not in visible]:
+            widget = self._virtual_cells.pop(index)
+            widget.place_forget()
+            if self._release_cell is not None:
+                self._release_cell(widget)
+            self._free_virtual_cells.append(widget)
+
+        for index in sorted(visible):
+            if index in self._virtual_cells:
+                continue
+            if self._free_virtual_cells:
+                widget = self._free_virtual_cells.pop()
+            else:
+                widget = self._create_cell(self._interior)
+            self._configure_cell(widget, index)
+            self._place_cell(widget, index)
+            self._virtual_cells[index] = widget
+
     def _update_scroll_region(self, event):
         """Update the scroll region when the interior widget is resized."""
 
@@ -344,83 +1407,1692 @@ class ScrolledFrame(Frame):
     _VALID_SCROLLBARS = "vertical", "horizontal", "both", "neither"
 
 
-class ImageSearch(Toplevel):
-    class StatusCodes(Enum):
-        NORMAL = 0
-        RETRIABLE_FETCHING_ERROR = 1
-        NON_RETRIABLE_FETCHING_ERROR = 2
-        IMAGE_PROCESSING_ERROR = 3
-
-    def __init__(self, master, search_term, saving_dir, **kwargs):
+class StreamingDownload:
+    """
+    Accumulates streamed response body and rejects it as soon as it is known
+    not to be an acceptable image: wrong Content-Type, too many bytes or too many pixels.
+    Image dimensions are read from the header bytes while the body is still arriving
+    """
+    CHUNK_SIZE = 16 * 1024
+    # dimensions of the image have to be found within this many first bytes, otherwise probing stops
+    PROBE_LIMIT = 256 * 1024
+    ACCEPTED_CONTENT_TYPES = ("application/octet-stream", "binary/octet-stream")
+    # JPEG markers: start of image, start of progressive frame, start of scan, end of image
+    SOI, SOF2, SOS, EOI = b"\xff\xd8", b"\xff\xc2", b"\xff\xda", b"\xff\xd9"
+
+    def __init__(self, max_bytes=None, max_pixels=None):
         """
-        master: \n
-        search_term: \n
-        saving_dir: \n
-        url_scrapper: function that returns image urls by given query\n
-        max_request_tries: how many retries allowed per one image-showing cycle\n
-        init_urls: custom urls to be displayed\n
-        headers: request headers\n
-        timeout: request timeout\n
-        show_image_width: maximum image display width\n
-        show_image_height: maximum image display height\n
-        saving_image_width: maximum image saving width\n
-        saving_image_height: maximum image saving height\n
-        image_saving_name_pattern: modifies saving name. example: "this_image_{}"\n
-        n_images_in_row: \n
-        n_rows: \n
-        button_padx: \n
-        button_pady: \n
-        window_width_limit: maximum width of the window\n
-        window_height_limit: maximum height of the window\n
-        window_bg: window background color\n
-        entry_params(**kwargs)s: entry widget params\n
-        command_button_params(**kwargs): "Show more" and "Download" buttons params\n
-        on_close_action(**kwargs): additional action performed on closing.
+        :param max_bytes: maximum size of response body
+        :param max_pixels: maximum number of pixels of the image
         """
-        self.search_term = search_term
-        self.img_urls = Deque(kwargs.get("init_urls", []))
-        self.url_scrapper = kwargs.get("url_scrapper")
+        self.max_bytes = max_bytes
+        self.max_pixels = max_pixels
+        self._buffer = bytearray()
+        self._probing = max_pixels is not None
+        self._previewing = True
+        self._first_scan_end = None
+        self._scan_search_start = 0
+
+    @property
+    def content(self) -> bytes:
+        return bytes(self._buffer)
+
+    @property
+    def n_bytes(self) -> int:
+        return len(self._buffer)
+
+    def check_response(self, status_code, headers):
+        """
+        checks headers of successful responses
+        :return: rejection status or None
+        """
+        if not 200 <= status_code < 300:
+            return None
 
-        if self.search_term and self.url_scrapper is not None:
-            try:
-                self.img_urls.extend(self.url_scrapper(self.search_term))
-            except ConnectionError:
-                messagebox.showerror(message="Check your internet connection")
+        content_type = headers.get("Content-Type", "").split(";")[0].strip().lower()
+        if content_type and not content_type.startswith("image/") and \
+                content_type not in self.ACCEPTED_CONTENT_TYPES:
+            return ImageFetcher.StatusCodes.NOT_AN_IMAGE
 
-        self.button_bg = self.activebackground = "#FFFFFF"
-        self.window_bg = kwargs.get("window_bg", "#F0F0F0")
-        self.command_button_params = kwargs.get("command_button_params", {})
-        self.entry_params = kwargs.get("entry_params", {})
-        self.button_padx = kwargs.get("button_padx", 10)
-        self.button_pady = kwargs.get("button_pady", 10)
-        Toplevel.__init__(self, master, bg=self.window_bg)
+        content_length = headers.get("Content-Length")
+        if self.max_bytes is not None and content_length is not None and content_length.isdigit() and \
+                int(content_length) > self.max_bytes:
+            return ImageFetcher.StatusCodes.RESPONSE_TOO_LARGE
+        return None
 
-        self.saving_dir = saving_dir
+    def feed(self, chunk: bytes):
+        """
+        :return: rejection status or None
+        """
+        self._buffer.extend(chunk)
+        if self.max_bytes is not None and len(self._buffer) > self.max_bytes:
+            return ImageFetcher.StatusCodes.RESPONSE_TOO_LARGE
+        if self._probing:
+            return self._probe_dimensions()
+        return None
+
+    def has_preview(self) -> bool:
+        """
+        checks whether the first scan of progressive JPEG is received and its preview isn't taken yet.
+        Baseline JPEGs and other formats are drawn top to bottom, so they have no preview
+        """
+        if not self._previewing or self._first_scan_end is not None:
+            return self._previewing
+        if len(self._buffer) >= len(self.SOI) and not self._buffer.startswith(self.SOI):
+            self._previewing = False
+            return False
+        first_scan = self._buffer.find(self.SOS)
+        if first_scan < 0:
+            self._previewing = len(self._buffer) < self.PROBE_LIMIT
+            return False
+        if self._buffer.find(self.SOF2, 0, first_scan) < 0:
+            self._previewing = False
+            return False
+        # markers can't appear inside of entropy-coded data, so the next SOS ends the first scan
+        next_scan = self._buffer.find(self.SOS, max(first_scan + len(self.SOS), self._scan_search_start))
+        if next_scan < 0:
+            self._scan_search_start = len(self._buffer) - 1
+            return False
+        self._first_scan_end = next_scan
+        return True
+
+    def take_preview(self, width: int = None, height: int = None):
+        """
+        decodes the received first scan of progressive JPEG into a coarse preview fitting into width and height.
+        Preview is given only once
+        :return: preview or None
+        """
+        if not self.has_preview():
+            return None
+        self._previewing = False
+        try:
+            img = Image.open(BytesIO(bytes(self._buffer[:self._first_scan_end]) + self.EOI))
+            size = ImageFetcher.fit_size(img.size, width, height)
+            img.draft("RGB", size)
+            return img.convert("RGB").resize(size, Image.BILINEAR)
+        except Exception:  # decoders fail with all kinds of errors on truncated data
+            return None
+
+    def _probe_dimensions(self):
+        try:
+            img = Image.open(BytesIO(self._buffer))
+        except Image.DecompressionBombError:
+            return ImageFetcher.StatusCodes.IMAGE_TOO_LARGE
+        except Exception:  # header is incomplete. Parsers fail with all kinds of errors on truncated data
+            self._probing = len(self._buffer) < self.PROBE_LIMIT
+            return None
+        self._probing = False
+        if img.width * img.height > self.max_pixels:
+            return ImageFetcher.StatusCodes.IMAGE_TOO_LARGE
+        return None
+
+
+class FetchMetrics:
+    """
+    Per-url stage timings, byte counts and outcomes of fetched images, aggregated into histograms on request.
+    Stages:
+        wait - waiting for a free connection slot
+        connect - establishing new connection (0 for reused ones, not measured by asyncio backend)
+        ttfb - from sending the request to receiving response headers
+        download - receiving response body
+        open - Image.open of fetched bytes (header parsing)
+        thumbnail - decoding and downscaling to display thumbnail
+        photo - creating ImageTk.PhotoImage of the thumbnail
+        save - resizing and writing saved image
+    Only the last max_records urls are kept
+    """
+    STAGES = ("wait", "connect", "ttfb", "download", "open", "thumbnail", "photo", "save")
+    HISTOGRAM_BOUNDS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+    FIELDS = ("url", "status", "bytes", "cached", "started_at") + STAGES
 
-        self.headers = kwargs.get("headers")
-        self.timeout = kwargs.get("timeout", 1)
-        self.max_request_tries = kwargs.get("max_request_tries", 1)
+    def __init__(self, max_records=10000):
+        self.max_records = max_records
+        self._records = OrderedDict()
+        self._lock = threading.Lock()
 
-        self.last_button_row = 0
-        self.last_button_column = 0
-        self.last_button_index = 0
-        self.n_images_in_row = kwargs.get("n_images_in_row", 3)
-        self.n_rows = kwargs.get("n_rows", 5)
-        self.n_images_per_cycle = self.n_rows * self.n_images_in_row
+    def begin(self, url):
+        """
+        starts new record of the url. Record of the previous attempt is replaced
+        """
+        record = dict.fromkeys(self.FIELDS)
+        record.update(url=url, bytes=0, cached=False, started_at=time.time())
+        with self._lock:
+            self._records.pop(url, None)
+            self._records[url] = record
+            if len(self._records) > self.max_records:
+                self._records.popitem(last=False)
+
+    def update(self, url, **fields):
+        """
+        sets fields (stage durations in seconds, bytes, cached, status) of the url record
+        """
+        with self._lock:
+            record = self._records.get(url)
+            if record is not None:
+                record.update(fields)
 
-        self.pool = ThreadPoolExecutor(max_workers=self.n_images_per_cycle)
+    def finish(self, url, status):
+        self.update(url, status=status.name)
 
-        self.saving_images = []
-        self.saving_images_names = []
-        self.saving_indices = []
+    def records(self) -> list:
+        with self._lock:
+            return [dict(record) for record in self._records.values()]
 
-        self.image_saving_name_pattern = kwargs.get("image_saving_name_pattern", "{}")
+    def clear(self):
+        with self._lock:
+            self._records.clear()
 
-        self.optimal_visual_width = kwargs.get("show_image_width")
-        self.optimal_visual_height = kwargs.get("show_image_height")
+    @classmethod
+    def histogram(cls, durations) -> dict:
+        """
+        :param durations: seconds
+        """
+        durations = sorted(duration * 1000 for duration in durations)
+        if not durations:
+            return {"count": 0}
+
+        def percentile(q):
+            return round(durations[min(len(durations) - 1, int(q / 100 * len(durations)))], 3)
+
+        buckets = OrderedDict((f"<={bound}", 0) for bound in cls.HISTOGRAM_BOUNDS_MS)
+        buckets[f">{cls.HISTOGRAM_BOUNDS_MS[-1]}"] = 0
+        keys = list(buckets)
+        for duration in durations:
+            index = next((i for i, bound in enumerate(cls.HISTOGRAM_BOUNDS_MS) if duration <= bound), -1)
+            buckets[keys[index]] += 1
+        return {"count": len(durations),
+                "mean_ms": round(sum(durations) / len(durations), 3),
+                "p50_ms": percentile(50),
+                "p95_ms": percentile(95),
+                "p99_ms": percentile(99),
+                "max_ms": round(durations[-1], 3),
+                "buckets_ms": buckets}
+
+    def stats(self) -> dict:
+        records = self.records()
+        statuses = {}
+        for record in records:
+            if record["status"] is not None:
+                statuses[record["status"]] = statuses.get(record["status"], 0) + 1
+        return {"urls": len(records),
+                "statuses": statuses,
+                "bytes": sum(record["bytes"] for record in records),
+                "cached": sum(record["cached"] for record in records),
+                "stages": {stage: self.histogram([record[stage] for record in records if record[stage] is not None])
+                           for stage in self.STAGES}}
+
+    def summary(self) -> str:
+        """
+        one line of median and 95th percentile of every stage
+        """
+        stages = self.stats()["stages"]
+        return "  ".join(f"{stage} {stages[stage]['p50_ms']:.0f}/{stages[stage]['p95_ms']:.0f}"
+                         for stage in self.STAGES if stages[stage]["count"]) + "  (p50/p95 ms)"
+
+    def export(self, path, export_format=None):
+        """
+        writes per-url records (csv) or records and aggregated stats (json)
+        :param export_format: "json" or "csv". Taken from the extension of the path by default
+        """
+        if export_format is None:
+            export_format = "csv" if path.lower().endswith(".csv") else "json"
+        if export_format == "csv":
+            with open(path, "w", newline="", encoding="utf-8") as f:
+                writer = csv.DictWriter(f, fieldnames=self.FIELDS)
+                writer.writeheader()
+                writer.writerows(self.records())
+        else:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump({"stats": self.stats(), "records": self.records()}, f, indent=2)
+
+
+class _HostState:
+    def __init__(self):
+        self.state = HostHealth.CLOSED
+        self.consecutive_failures = 0
+        self.n_trips = 0  # consecutive trips without a successful request
+        self.successes = 0
+        self.failures = 0
+        self.open_until = 0.0
+        self.not_before = 0.0  # Retry-After
+        self.probe_started = None
+
+
+class HostHealth:
+    """
+    Per-host circuit breakers. Host is tripped after failure_threshold consecutive failures
+    and isn't requested until its cooldown passes. Then a single probe request is let through:
+    its success closes the breaker, its failure trips it again with twice as long cooldown.
+    Hosts tripped max_trips times in a row are considered dead
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(self, failure_threshold=3, cooldown=5, max_cooldown=300, max_trips=4, clock=time.monotonic):
+        """
+        :param failure_threshold: number of consecutive failures that trips the breaker
+        :param cooldown: seconds the host isn't requested after the first trip
+        :param max_cooldown: cooldown limit
+        :param max_trips: number of trips in a row after which host is considered dead
+        """
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.max_trips = max_trips
+        self.clock = clock
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def default(cls):
+        """
+        :return: process-wide host health shared by fetchers that don't configure their own
+        """
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = cls()
+            return cls._default
+
+    @staticmethod
+    def parse_retry_after(value):
+        """
+        :param value: Retry-After header: seconds or HTTP date
+        :return: seconds or None
+        """
+        if not value:
+            return None
+        value = value.strip()
+        if value.isdigit():
+            return float(value)
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError, IndexError):
+            return None
+
+    def _host(self, url) -> _HostState:
+        host = urlsplit(url).netloc
+        state = self._hosts.get(host)
+        if state is None:
+            state = self._hosts[host] = _HostState()
+        return state
+
+    def record_success(self, url):
+        with self._lock:
+            host = self._host(url)
+            host.successes += 1
+            host.consecutive_failures = 0
+            host.n_trips = 0
+            host.state = HostHealth.CLOSED
+            host.probe_started = None
+
+    def record_failure(self, url, retry_after=None):
+        """
+        :param retry_after: seconds the host asked to wait
+        """
+        with self._lock:
+            host = self._host(url)
+            now = self.clock()
+            host.failures += 1
+            host.consecutive_failures += 1
+            host.probe_started = None
+            if retry_after is not None:
+                host.not_before = max(host.not_before, now + retry_after)
+            if host.state == HostHealth.OPEN:  # request was sent before the trip
+                return
+            if host.state == HostHealth.HALF_OPEN or host.consecutive_failures >= self.failure_threshold:
+                host.state = HostHealth.OPEN
+                host.open_until = now + min(self.max_cooldown, self.cooldown * 2 ** host.n_trips)
+                host.n_trips += 1
+
+    def _delay(self, host, now):
+        if host.state == HostHealth.OPEN and now >= host.open_until:
+            host.state = HostHealth.HALF_OPEN
+        if host.state == HostHealth.HALF_OPEN and host.probe_started is not None and \
+                now < host.probe_started + self.cooldown:  # probe is in flight
+            return host.probe_started + self.cooldown - now
+        return max(host.open_until - now if host.state == HostHealth.OPEN else 0.0, host.not_before - now, 0.0)
+
+    def delay(self, url) -> float:
+        """
+        :return: seconds until the host of the url can be requested
+        """
+        with self._lock:
+            return self._delay(self._host(url), self.clock())
+
+    def acquire(self, url) -> bool:
+        """
+        :return: whether the url may be requested now. Takes the probe slot of recovering hosts
+        """
+        with self._lock:
+            host = self._host(url)
+            now = self.clock()
+            if self._delay(host, now) > 0:
+                return False
+            if host.state == HostHealth.HALF_OPEN:
+                host.probe_started = now
+            return True
+
+    def is_dead(self, url) -> bool:
+        with self._lock:
+            return self._host(url).n_trips >= self.max_trips
+
+    def report(self) -> dict:
+        """
+        :return: {host: health} of every requested host
+        """
+        with self._lock:
+            now = self.clock()
+            return {name: {"state": host.state if host.n_trips < self.max_trips else "dead",
+                           "successes": host.successes,
+                           "failures": host.failures,
+                           "consecutive_failures": host.consecutive_failures,
+                           "trips": host.n_trips,
+                           "available_in": round(self._delay(host, now), 3)}
+                    for name, host in self._hosts.items()}
+
+
+class RetryScheduler:
+    """
+    Urls waiting to be retried. Delay before n-th retry of an url is drawn uniformly from
+    [base_delay * 2 ** n / 2, base_delay * 2 ** n] (up to max_delay) and is never shorter
+    than the time its host is unavailable for (tripped circuit breaker, Retry-After)
+    """
+    def __init__(self, host_health: HostHealth, base_delay=0.5, max_delay=30, max_retries=2):
+        """
+        :param max_retries: how many times an url is retried
+        """
+        self.host_health = host_health
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retries = max_retries
+        self._heap = []
+        self._counter = itertools.count()
+        self._n_retries = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __bool__(self):
+        return bool(self._heap)
+
+    def _push(self, url, payload, delay):
+        delay = max(delay, self.host_health.delay(url))
+        with self._lock:
+            heapq.heappush(self._heap, (self.host_health.clock() + delay, next(self._counter), url, payload))
+
+    def schedule(self, url, payload=None) -> bool:
+        """
+        :return: False if the url has used up its retries
+        """
+        with self._lock:
+            n_retries = self._n_retries.get(url, 0)
+            if n_retries >= self.max_retries:
+                return False
+            self._n_retries[url] = n_retries + 1
+        backoff = min(self.max_delay, self.base_delay * 2 ** n_retries)
+        self._push(url, payload, random.uniform(backoff / 2, backoff))
+        return True
+
+    def defer(self, url, payload=None):
+        """
+        postpones url until its host is available without using up its retries
+        """
+        self._push(url, payload, 0)
+
+    def pop_ready(self, n=None) -> list:
+        """
+        :return: up to n (url, payload) whose delay has passed
+        """
+        ready = []
+        now = self.host_health.clock()
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now and (n is None or len(ready) < n):
+                _, _, url, payload = heapq.heappop(self._heap)
+                ready.append((url, payload))
+        return ready
+
+    def next_delay(self):
+        """
+        :return: seconds until the next url is ready or None
+        """
+        with self._lock:
+            if not self._heap:
+                return None
+            return max(0.0, self._heap[0][0] - self.host_health.clock())
+
+    def clear(self):
+        with self._lock:
+            self._heap = []
+            self._n_retries = {}
+
+
+class HammingIndex:
+    """
+    BK-tree of integer image hashes that finds stored hashes within given Hamming distance
+    """
+    def __init__(self):
+        self._root = None  # [hash, {distance: child node}]
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @staticmethod
+    def distance(a: int, b: int) -> int:
+        return bin(a ^ b).count("1")
+
+    def add(self, value: int):
+        self._size += 1
+        if self._root is None:
+            self._root = [value, {}]
+            return
+        node = self._root
+        while True:
+            d = self.distance(value, node[0])
+            if d == 0:
+                self._size -= 1
+                return
+            child = node[1].get(d)
+            if child is None:
+                node[1][d] = [value, {}]
+                return
+            node = child
+
+    def find(self, value: int, max_distance: int):
+        """
+        :return: some stored hash within max_distance from value or None
+        """
+        candidates = [self._root] if self._root is not None else []
+        while candidates:
+            node = candidates.pop()
+            d = self.distance(value, node[0])
+            if d <= max_distance:
+                return node[0]
+            candidates.extend(child for child_distance, child in node[1].items()
+                              if d - max_distance <= child_distance <= d + max_distance)
+        return None
+
+
+class AdaptiveConcurrency:
+    """
+    Limit of simultaneous fetches that is adjusted at runtime by outcomes of finished fetches (AIMD).
+    Outcomes are judged in windows of about `limit` fetches:
+        retriable errors (timeouts, refused connections, 429/5xx) above max_error_rate - limit is multiplied by
+            decrease
+        median latency above latency_tolerance times the baseline (the lowest median seen, slowly forgotten) -
+            limit is multiplied by decrease, unless throughput grew enough to explain the queuing
+        otherwise limit grows by increase, if it was reached during the window
+    Limit stays between min_limit and max_limit
+    """
+    HISTORY_SIZE = 100
+
+    def __init__(self, initial_limit=8, min_limit=2, max_limit=64, increase=1, decrease=0.7, max_error_rate=0.05,
+                 latency_tolerance=2.0, min_window=8, baseline_drift=0.02, clock=time.monotonic):
+        """
+        :param initial_limit: limit before the first adjustment
+        :param min_limit: floor of the limit
+        :param max_limit: ceiling of the limit
+        :param increase: additive increase of the limit after a good window
+        :param decrease: multiplicative decrease of the limit after a congested window
+        :param max_error_rate: share of retriable errors in a window that is considered congestion
+        :param latency_tolerance: how many times median latency may exceed the baseline
+        :param min_window: minimum number of fetches in a window
+        :param baseline_drift: how much baseline latency grows every window, so that it follows the network
+        """
+        if not 1 <= min_limit <= max_limit:
+            raise ValueError("expected 1 <= min_limit <= max_limit")
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.max_error_rate = max_error_rate
+        self.latency_tolerance = latency_tolerance
+        self.min_window = min_window
+        self.baseline_drift = baseline_drift
+        self.clock = clock
+        self._limit = float(min(max(initial_limit, min_limit), max_limit))
+        self.in_flight = 0
+        self.baseline_latency = None
+        self.last_window = None
+        self.history = deque(maxlen=self.HISTORY_SIZE)  # (time, limit, reason) of every adjustment
+        self._condition = threading.Condition()
+        self._reset_window()
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    def _reset_window(self):
+        self._latencies = []
+        self._n_errors = 0
+        self._n_bytes = 0
+        self._window_start = self.clock()
+        self._peak_in_flight = self.in_flight
+
+    def try_acquire(self) -> bool:
+        """
+        takes a fetch slot if the limit allows
+        """
+        with self._condition:
+            if self.in_flight >= self.limit:
+                return False
+            self.in_flight += 1
+            self._peak_in_flight = max(self._peak_in_flight, self.in_flight)
+            return True
+
+    def acquire(self, timeout=None) -> bool:
+        """
+        waits for a fetch slot
+        :return: False if timeout passed
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: self.in_flight < self.limit, timeout):
+                return False
+            self.in_flight += 1
+            self._peak_in_flight = max(self._peak_in_flight, self.in_flight)
+            return True
+
+    def release(self, latency=None, error=False, n_bytes=0):
+        """
+        frees the fetch slot
+        :param latency: duration of the fetch in seconds. None for fetches that tell nothing about the network
+            (cancelled ones, cache hits, local files)
+        :param error: fetch failed with retriable error
+        :param n_bytes: number of fetched bytes
+        """
+        with self._condition:
+            self.in_flight -= 1
+            if latency is not None:
+                self._latencies.append(latency)
+                self._n_errors += bool(error)
+                self._n_bytes += n_bytes
+                if len(self._latencies) >= max(self.min_window, self.limit):
+                    self._adjust()
+            self._condition.notify_all()
+
+    def _adjust(self):
+        now = self.clock()
+        latencies = sorted(self._latencies)
+        window = {"latency": latencies[len(latencies) // 2],
+                  "error_rate": self._n_errors / len(latencies),
+                  "throughput": self._n_bytes / max(now - self._window_start, 1e-6)}
+        previous, self.last_window = self.last_window, window
+        saturated = self._peak_in_flight >= self.limit
+
+        if self.baseline_latency is None:
+            self.baseline_latency = window["latency"]
+        else:
+            self.baseline_latency = min(self.baseline_latency * (1 + self.baseline_drift), window["latency"])
+        queuing = window["latency"] > self.latency_tolerance * self.baseline_latency
+        throughput_grew = previous is not None and window["throughput"] > previous["throughput"] * 1.1
+
+        limit = self.limit
+        reason = None
+        if window["error_rate"] > self.max_error_rate:
+            reason = "errors"
+        elif queuing and not throughput_grew:
+            reason = "latency"
+        if reason is not None:
+            self._limit = max(self.min_limit, self._limit * self.decrease)
+        elif saturated and not queuing:
+            self._limit = min(self.max_limit, self._limit + self.increase)
+            reason = "increase"
+        if self.limit != limit:
+            self.history.append((now, self.limit, reason))
+        self._reset_window()
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {"limit": self.limit,
+                    "in_flight": self.in_flight,
+                    "min_limit": self.min_limit,
+                    "max_limit": self.max_limit,
+                    "baseline_latency_ms": round(self.baseline_latency * 1000, 2)
+                    if self.baseline_latency is not None else None,
+                    "last_window": dict(self.last_window) if self.last_window is not None else None,
+                    "adjustments": list(self.history)[-10:]}
+
+
+class FetchBackend:
+    """
+    Base of the fetch backends shared by ImageSearch windows (owners).
+    Jobs of a more urgent priority (lower value) are started first. Owners with jobs of the same priority
+    take turns, so that a window with many queued images doesn't hold up the others. Jobs of one owner
+    are started in order of submission. Futures of every owner are kept so that its work can be cancelled.
+    Number of fetches in flight is limited by AdaptiveConcurrency. Images are decoded outside of the limit
+    """
+    VISIBLE_PRIORITY = 0
+    PREFETCH_PRIORITY = 1
+
+    def __init__(self, concurrency: AdaptiveConcurrency):
+        self.concurrency = concurrency
+        self._futures = {}  # owner -> set of its futures
+        self._queues = {}  # priority -> OrderedDict(owner -> deque of its jobs), first owner goes next
+        self._owners = set()
+        self._lock = threading.Lock()
+
+    def register(self, owner):
+        with self._lock:
+            self._owners.add(owner)
+
+    def unregister(self, owner):
+        """
+        releases all work of the owner
+        """
+        self.cancel(owner)
+        with self._lock:
+            self._owners.discard(owner)
+
+    def submit(self, search, url, batch, priority=VISIBLE_PRIORITY):
+        """
+        fetches url and hands the result to search.process_and_enqueue.
+        Url whose job raises is handed to search.enqueue_failure
+        """
+        raise NotImplementedError
+
+    def _enqueue(self, search, url, batch, priority):
+        """
+        queues the job. Caller makes sure some worker picks it up with _pop_job
+        """
+        future = Future()
+        self._track(search, future)
+        with self._lock:
+            owners = self._queues.setdefault(priority, OrderedDict())
+            owners.setdefault(search, deque()).append((future, search, url, batch))
+        return future
+
+    def _pop_job(self):
+        """
+        :return: next (future, search, url, batch) or None
+        """
+        with self._lock:
+            for priority in sorted(self._queues):
+                owners = self._queues[priority]
+                owner, jobs = next(iter(owners.items()))
+                job = jobs.popleft()
+                if jobs:
+                    owners.move_to_end(owner)
+                else:
+                    del owners[owner]
+                if not owners:
+                    del self._queues[priority]
+                return job
+        return None
+
+    def promote(self, owner, batch, priority=VISIBLE_PRIORITY):
+        """
+        moves queued jobs of the batch to a more urgent priority
+        """
+        with self._lock:
+            for job_priority, owners in list(self._queues.items()):
+                jobs = owners.get(owner)
+                if job_priority <= priority or not jobs:
+                    continue
+                promoted = [job for job in jobs if job[3] is batch]
+                if not promoted:
+                    continue
+                owners[owner] = deque(job for job in jobs if job[3] is not batch)
+                if not owners[owner]:
+                    del owners[owner]
+                    if not owners:
+                        del self._queues[job_priority]
+                self._queues.setdefault(priority, OrderedDict()).setdefault(owner, deque()).extend(promoted)
+
+    def _track(self, owner, future):
+        with self._lock:
+            self._futures.setdefault(owner, set()).add(future)
+
+        def forget(done_future):
+            with self._lock:
+                self._futures.get(owner, set()).discard(done_future)
+        future.add_done_callback(forget)
+
+    def cancel(self, owner):
+        with self._lock:
+            futures = self._futures.pop(owner, set())
+            for priority, owners in list(self._queues.items()):
+                owners.pop(owner, None)
+                if not owners:
+                    del self._queues[priority]
+        for future in futures:
+            future.cancel()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"owners": len(self._owners),
+                    "queued": {priority: sum(map(len, owners.values()))
+                               for priority, owners in sorted(self._queues.items())},
+                    "in_flight": sum(future.running() for futures in self._futures.values() for future in futures),
+                    "concurrency": self.concurrency.stats()}
+
+    def _release_fetch_slot(self, content=None, request_start=None):
+        """
+        outcomes of requests adjust the concurrency limit. Cache hits and local files don't
+        :param content: fetched content or status, None if fetch didn't finish
+        :param request_start: time.monotonic() of the request, None if nothing was requested
+        """
+        if content is None or request_start is None or content is ImageFetcher.StatusCodes.CANCELLED:
+            self.concurrency.release()
+            return
+        self.concurrency.release(latency=time.monotonic() - request_start,
+                                 error=content is ImageFetcher.StatusCodes.RETRIABLE_FETCHING_ERROR,
+                                 n_bytes=len(content) if isinstance(content, bytes) else 0)
+
+    @staticmethod
+    def _report_failure(search, url, batch, error):
+        """
+        unexpected error of the job fails its image instead of leaving the batch waiting for it forever
+        """
+        logger.error("fetching %s failed", url, exc_info=error)
+        search.enqueue_failure(url, batch)
+
+    def shutdown(self):
+        pass
+
+
+class ThreadFetchBackend(FetchBackend):
+    """
+    Fetches and processes every image on a worker thread of the pool.
+    Only work that hasn't started yet can be cancelled
+    """
+    DEFAULT_MAX_WORKERS = 64
+
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS, concurrency: AdaptiveConcurrency = None):
+        """
+        :param max_workers: maximum number of images fetched and processed at once by all owners
+        :param concurrency: limit of fetches in flight. Adapts between 2 and max_workers by default
+        """
+        super(ThreadFetchBackend, self).__init__(concurrency or AdaptiveConcurrency(max_limit=max_workers))
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+
+    @classmethod
+    def default(cls):
+        """
+        :return: process-wide backend used by windows created with fetch_backend="threads"
+        """
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = cls()
+            return cls._default
+
+    def submit(self, search, url, batch, priority=FetchBackend.VISIBLE_PRIORITY):
+        self._enqueue(search, url, batch, priority)
+        # every pool task runs the most urgent job waiting at the moment it starts
+        self.pool.submit(self._run_next_job)
+
+    def _run_next_job(self):
+        self.concurrency.acquire()
+        job = self._pop_job()
+        if job is None or not job[0].set_running_or_notify_cancel():  # cancelled
+            self.concurrency.release()
+            return
+        future, search, url, batch = job
+        content = None
+        request_start = []
+        try:
+            try:
+                content, url = search.fetch_item(url, batch, on_request=lambda: request_start.append(time.monotonic()))
+            finally:
+                self._release_fetch_slot(content, request_start[0] if request_start else None)
+            search.process_and_enqueue(content, url, batch)
+        except Exception as e:  # cache, decode pool, ...
+            self._report_failure(search, url, batch, e)
+            future.set_result(None)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(None)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False)
+
+
+class AsyncioFetchBackend(FetchBackend):
+    """
+    Fetches images with aiohttp on a single background asyncio event loop.
+    Fetched data is decoded and prepared on a small thread pool, so hundreds of downloads
+    can be in flight without an OS thread per download
+    """
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(self, max_concurrency=256, max_concurrency_per_host=8, decode_workers=None,
+                 concurrency: AdaptiveConcurrency = None):
+        """
+        :param max_concurrency: maximum number of simultaneous downloads
+        :param max_concurrency_per_host: maximum number of simultaneous downloads from one host
+        :param decode_workers: number of threads that decode fetched images
+        :param concurrency: limit of downloads in flight. Adapts between 2 and max_concurrency by default
+        """
+        super(AsyncioFetchBackend, self).__init__(concurrency or AdaptiveConcurrency(max_limit=max_concurrency))
+        try:
+            import aiohttp
+        except ImportError:
+            raise ImportError("asyncio fetch backend requires aiohttp to be installed")
+        self._aiohttp = aiohttp
+        self.max_concurrency = max_concurrency
+        self.max_concurrency_per_host = max_concurrency_per_host
+        self.decode_pool = ThreadPoolExecutor(max_workers=decode_workers)
+
+        self._session = None
+        self._tasks = {}  # future of running job -> its task
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="AsyncioFetchBackend", daemon=True)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._start_workers(), self._loop).result()
+
+    async def _start_workers(self):
+        self._job_available = asyncio.Semaphore(0)
+        self._slot_released = asyncio.Event()
+        self._workers = [asyncio.ensure_future(self._worker()) for _ in range(self.max_concurrency)]
+
+    def _release_fetch_slot(self, content=None, request_start=None):
+        super(AsyncioFetchBackend, self)._release_fetch_slot(content, request_start)
+        self._slot_released.set()
+
+    async def _worker(self):
+        while True:
+            await self._job_available.acquire()
+            while not self.concurrency.try_acquire():  # slots are released on this loop only
+                self._slot_released.clear()
+                await self._slot_released.wait()
+            job = self._pop_job()
+            if job is None or not job[0].set_running_or_notify_cancel():  # cancelled
+                self._release_fetch_slot()
+                continue
+            future, search, url, batch = job
+            task = asyncio.ensure_future(self._fetch_and_process(search, url, batch))
+            with self._lock:
+                self._tasks[future] = task
+            await asyncio.wait({task})
+            with self._lock:
+                del self._tasks[future]
+            if not task.cancelled() and isinstance(task.exception(), Exception):
+                self._report_failure(search, url, batch, task.exception())
+                future.set_result(None)
+            elif not task.cancelled() and task.exception() is not None:
+                future.set_exception(task.exception())
+            else:
+                future.set_result(None)
+
+    @classmethod
+    def default(cls):
+        """
+        :return: process-wide backend used by windows created with fetch_backend="asyncio"
+        """
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = cls()
+            return cls._default
+
+    def _get_session(self):
+        if self._session is None:
+            connector = self._aiohttp.TCPConnector(limit=self.max_concurrency,
+                                                   limit_per_host=self.max_concurrency_per_host)
+            self._session = self._aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def _fetch(self, search, url, token, on_chunk=None, on_request=None):
+        if token is not None and token.cancelled:
+            return ImageFetcher.StatusCodes.CANCELLED, url
+        loop = asyncio.get_running_loop()
+        metrics = search.metrics
+        if metrics is not None:
+            metrics.begin(url)
+        cached, headers = await loop.run_in_executor(self.decode_pool, search.prepare_request, url)
+        if cached is not None and cached.is_fresh:
+            if metrics is not None:
+                metrics.update(url, cached=True, bytes=len(cached.content))
+            return cached.content, url
+
+        timeout = self._aiohttp.ClientTimeout(sock_connect=search.timeout, sock_read=search.timeout)
+        download = search.new_download()
+        if on_request is not None:
+            on_request()
+        try:
+            start = time.perf_counter()
+            async with self._get_session().get(url, headers=headers, timeout=timeout) as response:
+                if metrics is not None:
+                    headers_received = time.perf_counter()
+                    metrics.update(url, ttfb=headers_received - start)
+                search.check_host_response(url, response.status, response.headers)
+                rejection = download.check_response(response.status, response.headers)
+                if rejection is None and 200 <= response.status < 300:
+                    async for chunk in response.content.iter_chunked(StreamingDownload.CHUNK_SIZE):
+                        rejection = download.feed(chunk)
+                        if rejection is not None or token is not None and token.cancelled:
+                            break
+                        if on_chunk is not None and download.has_preview():
+                            await loop.run_in_executor(self.decode_pool, on_chunk, download)
+                if metrics is not None:
+                    metrics.update(url, download=time.perf_counter() - headers_received, bytes=download.n_bytes)
+        except (asyncio.TimeoutError, self._aiohttp.ClientConnectionError, self._aiohttp.ClientPayloadError):
+            search.host_health.record_failure(url)
+            return search.handle_fetching_error(url, cached, retriable=True)
+        except (self._aiohttp.ClientError, ValueError):
+            return search.handle_fetching_error(url, cached, retriable=False)
+        if token is not None and token.cancelled:
+            return ImageFetcher.StatusCodes.CANCELLED, url
+        if rejection is not None:
+            return rejection, url
+        return await loop.run_in_executor(self.decode_pool, search.handle_response,
+                                          url, cached, response.status, response.headers, download.content)
+
+    async def _fetch_and_process(self, search, url, batch):
+        loop = asyncio.get_running_loop()
+        content = None
+        request_start = []
+        try:
+            if batch.local:  # files are read by the pool
+                content = await loop.run_in_executor(self.decode_pool, search.read_file, url)
+            else:
+                content, url = await self._fetch(search, url, batch.token, search.preview_handler(url, batch),
+                                                 on_request=lambda: request_start.append(time.monotonic()))
+        finally:
+            self._release_fetch_slot(content, request_start[0] if request_start else None)
+        if batch.cancelled:
+            return
+        await loop.run_in_executor(self.decode_pool, search.process_and_enqueue, content, url, batch)
+
+    def submit(self, search, url, batch, priority=FetchBackend.VISIBLE_PRIORITY):
+        self._enqueue(search, url, batch, priority)
+        self._loop.call_soon_threadsafe(self._job_available.release)
+
+    def cancel(self, owner):
+        """
+        cancels all jobs of the owner, including downloads in flight
+        """
+        with self._lock:
+            tasks = [task for future, task in self._tasks.items() if future in self._futures.get(owner, ())]
+        super(AsyncioFetchBackend, self).cancel(owner)
+        for task in tasks:
+            self._loop.call_soon_threadsafe(task.cancel)
+
+    def shutdown(self):
+        async def close():
+            for worker in self._workers:
+                worker.cancel()
+            await asyncio.wait(self._workers)
+            if self._session is not None:
+                await self._session.close()
+        asyncio.run_coroutine_threadsafe(close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self.decode_pool.shutdown(wait=False)
+
+
+def _decode_in_process(content, width, height, with_hash):
+    """
+    worker of DecodeProcessPool. Pixels of the thumbnail are written to a new shared memory block of their size,
+    which is unlinked by the pool
+    :return: status, mode, size, image hash, name of the block, pixels if the block couldn't be created
+    """
+    try:
+        thumbnail = ImageFetcher.make_thumbnail(Image.open(BytesIO(content)), width, height)
+        if thumbnail.mode not in DecodeProcessPool.MODES:
+            thumbnail = thumbnail.convert("RGBA" if "A" in thumbnail.getbands() or "transparency" in thumbnail.info
+                                          else "RGB")
+        image_hash = ImageFetcher.image_hash(thumbnail) if with_hash else None
+    except (IOError, UnicodeError, ValueError, Image.DecompressionBombError):
+        return ImageFetcher.StatusCodes.IMAGE_PROCESSING_ERROR, None, None, None, None, None
+
+    pixels = thumbnail.tobytes()
+    from multiprocessing import shared_memory
+    try:
+        block = shared_memory.SharedMemory(create=True, size=len(pixels))
+    except (OSError, ValueError):  # shared memory is full or unavailable
+        return ImageFetcher.StatusCodes.NORMAL, thumbnail.mode, thumbnail.size, image_hash, None, pixels
+    try:
+        block.buf[:len(pixels)] = pixels
+    finally:
+        block.close()
+    return ImageFetcher.StatusCodes.NORMAL, thumbnail.mode, thumbnail.size, image_hash, block.name, None
+
+
+class DecodeProcessPool:
+    """
+    Decodes fetched images and prepares their display thumbnails in worker processes, so that decoding
+    isn't limited by the GIL. Compressed bytes are sent to the workers, pixels of the thumbnails come back
+    through shared memory blocks of their size, created by the workers. Calls block the calling thread
+    """
+    # modes that PhotoImage shows without conversion. Other thumbnails are converted by the workers
+    MODES = ("1", "L", "RGB", "RGBA")
+
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(self, max_workers=None):
+        """
+        :param max_workers: number of worker processes. Number of cores by default
+        """
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        from multiprocessing import shared_memory
+        self._shared_memory = shared_memory
+        self.max_workers = max_workers or os.cpu_count()
+        # workers are spawned instead of forked: forking a process running Tk and threads isn't safe
+        self.pool = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+        self._lock = threading.Lock()
+        self.n_decoded = 0
+        self.n_shared = 0
+        self.shared_bytes = 0
+        self.n_copied = 0  # thumbnails that didn't get shared memory and were pickled
+
+    @classmethod
+    def default(cls):
+        """
+        :return: process-wide pool used by windows created with decode_processes=True
+        """
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = cls()
+                atexit.register(cls._default.shutdown)  # shared memory outlives the process otherwise
+            return cls._default
+
+    def decode(self, content: bytes, width: int = None, height: int = None, with_hash=False):
+        """
+        :param width: maximum thumbnail width
+        :param height: maximum thumbnail height
+        :param with_hash: compute ImageFetcher.image_hash of the thumbnail
+        :return: status, thumbnail, image hash
+        """
+        status, mode, image_size, image_hash, block_name, pixels = self.pool.submit(
+            _decode_in_process, content, width, height, with_hash).result()
+        if status != ImageFetcher.StatusCodes.NORMAL:
+            return status, None, None
+        if block_name is not None:
+            block = self._shared_memory.SharedMemory(name=block_name)
+            try:
+                thumbnail = Image.frombytes(mode, image_size, block.buf)  # the only copy of the pixels on this side
+                n_bytes = block.size
+            finally:
+                block.close()
+                block.unlink()
+        else:
+            thumbnail = Image.frombytes(mode, image_size, pixels)
+        with self._lock:
+            self.n_decoded += 1
+            if block_name is not None:
+                self.n_shared += 1
+                self.shared_bytes += n_bytes
+            else:
+                self.n_copied += 1
+        return status, thumbnail, image_hash
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"workers": self.max_workers,
+                    "decoded": self.n_decoded,
+                    "copied": self.n_copied,
+                    "shared": self.n_shared,
+                    "shared_bytes": self.shared_bytes}
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
+
+
+class CancellationToken:
+    """
+    Flag shared by the work of one search. Cancelling it aborts downloads in flight
+    and keeps their results from being decoded and shown
+    """
+    def __init__(self):
+        self._event = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self):
+        with self._lock:
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                pass
+
+    @contextmanager
+    def on_cancel(self, callback):
+        """
+        calls callback (from the cancelling thread) if the token is cancelled inside the with block
+        """
+        with self._lock:
+            registered = not self._event.is_set()
+            if registered:
+                self._callbacks.append(callback)
+        if not registered:
+            callback()
+        try:
+            yield
+        finally:
+            with self._lock:
+                if callback in self._callbacks:
+                    self._callbacks.remove(callback)
+
+
+# preview results carry coarse thumbnail of the image that is still being fetched
+FetchResult = namedtuple("FetchResult", ["batch", "url", "status", "thumbnail", "content", "image_hash", "preview"],
+                         defaults=(False,))
+
+
+class FetchBatch:
+    """
+    Group of fetches started by one image-showing cycle.
+    Failed fetches of the batch may be replaced by the next urls while tries_left > 0
+    """
+    def __init__(self, tries_left=0, prefetch=False, token=None, local=False):
+        """
+        :param prefetch: results of prefetch batch are buffered for the next pages instead of being shown
+        :param token: CancellationToken of the search the batch belongs to
+        :param local: batch of local files (paths instead of urls) that are read instead of being fetched
+        """
+        self.n_pending = 0
+        self.urls = set()  # urls being fetched
+        self.tries_left = tries_left
+        self.prefetch = prefetch
+        self.token = token
+        self.local = local
+
+    @property
+    def cancelled(self) -> bool:
+        return self.token is not None and self.token.cancelled
+
+    def __repr__(self):
+        return f"FetchBatch(n_pending={self.n_pending}, tries_left={self.tries_left}, prefetch={self.prefetch}, " \
+               f"local={self.local})"
+
+
+class ImageFetcher:
+    """
+    Fetching, processing and saving of images that doesn't depend on Tk.
+    Base of ImageSearch window and of headless BatchImageSearch
+    """
+    class StatusCodes(Enum):
+        NORMAL = 0
+        RETRIABLE_FETCHING_ERROR = 1
+        NON_RETRIABLE_FETCHING_ERROR = 2
+        IMAGE_PROCESSING_ERROR = 3
+        NOT_AN_IMAGE = 4
+        RESPONSE_TOO_LARGE = 5
+        IMAGE_TOO_LARGE = 6
+        DUPLICATE_IMAGE = 7
+        HOST_UNAVAILABLE = 8
+        CANCELLED = 9
+
+    # file extensions of saving formats whose extension differs from lowercase format name
+    SAVING_EXTENSIONS = {"JPEG": "jpg", "TIFF": "tif"}
+    # responses that count as host failures and are worth retrying
+    RETRIABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+    # default of max_image_pixels: Image.MAX_IMAGE_PIXELS, looked up on use so that constructor doesn't import PIL
+    _PIL_PIXEL_LIMIT = object()
+
+    def __init__(self, **kwargs):
+        """
+        headers: request headers\n
+        http_client: HTTPClient used for fetching. Shared HTTPClient.default() is used if none of
+            http_client, max_connections, max_connections_per_host, http_retries are given\n
+        max_connections: maximum number of simultaneous requests\n
+        max_connections_per_host: maximum number of simultaneous requests to one host\n
+        http_retries: how many times failed connections are retried by the http client\n
+        image_cache: ImageCache instance used to keep fetched images and thumbnails between sessions\n
+        timeout: request timeout\n
+        max_download_size: downloads larger than this many bytes are aborted\n
+        max_image_pixels: images with more pixels are rejected as soon as their header is fetched\n
+        show_image_width: maximum image display width\n
+        show_image_height: maximum image display height\n
+        saving_image_width: maximum image saving width\n
+        saving_image_height: maximum image saving height\n
+        saving_image_format: format of saved images: "png" (default), "jpeg", "webp", ...\n
+        saving_image_quality: quality of lossy saving formats\n
+        image_saving_name_pattern: modifies saving name. example: "this_image_{}"\n
+        metrics: True or FetchMetrics instance to record per-url stage timings. Disabled by default\n
+        host_health: HostHealth tracking failures of hosts. Shared HostHealth.default() by default\n
+        max_retries: how many times url that failed with retriable error is retried\n
+        retry_base_delay: delay before the first retry, doubled for every next one\n
+        retry_max_delay: maximum delay between retries
+        """
+        metrics = kwargs.get("metrics")
+        self.metrics = FetchMetrics() if metrics is True else metrics or None
+        self.headers = kwargs.get("headers")
+        self.http_client = kwargs.get("http_client")
+        self.owns_http_client = self.http_client is None and \
+            any(kwarg in kwargs for kwarg in ("max_connections", "max_connections_per_host", "http_retries"))
+        if self.owns_http_client:
+            self.http_client = HTTPClient(max_connections=kwargs.get("max_connections", 32),
+                                          max_connections_per_host=kwargs.get("max_connections_per_host", 6),
+                                          retries=kwargs.get("http_retries", 0))
+        elif self.http_client is None:
+            self.http_client = HTTPClient.default()
+        self.image_cache = kwargs.get("image_cache")
+        self.timeout = kwargs.get("timeout", 1)
+        self.max_download_size = kwargs.get("max_download_size", 20 * 2 ** 20)
+        self._max_image_pixels = kwargs.get("max_image_pixels", ImageFetcher._PIL_PIXEL_LIMIT)
+
+        self.image_saving_name_pattern = kwargs.get("image_saving_name_pattern", "{}")
+
+        self.optimal_visual_width = kwargs.get("show_image_width")
+        self.optimal_visual_height = kwargs.get("show_image_height")
 
         self.optimal_result_width = kwargs.get("saving_image_width")
         self.optimal_result_height = kwargs.get("saving_image_height")
+        self.saving_image_format = kwargs.get("saving_image_format", "png").upper()
+        if self.saving_image_format == "JPG":
+            self.saving_image_format = "JPEG"
+        self.saving_image_quality = kwargs.get("saving_image_quality", 90)
+
+        self.host_health = kwargs.get("host_health") or HostHealth.default()
+        self.retry_scheduler = RetryScheduler(self.host_health,
+                                              base_delay=kwargs.get("retry_base_delay", 0.5),
+                                              max_delay=kwargs.get("retry_max_delay", 30),
+                                              max_retries=kwargs.get("max_retries", 2))
+
+    @property
+    def max_image_pixels(self):
+        if self._max_image_pixels is ImageFetcher._PIL_PIXEL_LIMIT:
+            return Image.MAX_IMAGE_PIXELS
+        return self._max_image_pixels
+
+    def close_fetching(self):
+        if self.owns_http_client:
+            self.http_client.close()
+
+    @staticmethod
+    def prepare_image(img, width: int = None, height: int = None):
+        processed_img = copy.copy(img)
+        if width is not None and processed_img.width > width:
+            k_width = width / processed_img.width
+            processed_img = processed_img.resize((width, int(processed_img.height * k_width)),
+                                                 Image.LANCZOS)
+
+        if height is not None and processed_img.height > height:
+            k_height = height / processed_img.height
+            processed_img = processed_img.resize((int(processed_img.width * k_height), height),
+                                                 Image.LANCZOS)
+        return processed_img
+
+    @staticmethod
+    def fit_size(size, width: int = None, height: int = None):
+        """
+        :return: largest size with the aspect ratio of the given size that fits into width and height
+        """
+        img_width, img_height = size
+        scale = 1
+        if width is not None and img_width > width:
+            scale = width / img_width
+        if height is not None and img_height * scale > height:
+            scale = height / img_height
+        if scale == 1:
+            return size
+        return max(1, round(img_width * scale)), max(1, round(img_height * scale))
+
+    @staticmethod
+    def make_thumbnail(img, width: int = None, height: int = None):
+        """
+        fast version of prepare_image for display thumbnails of just opened (not yet loaded) images.
+        JPEGs are downscaled by the decoder, other images are reduced by an integer factor
+        before a single resample to the final size. Image is returned as is if it already fits
+        """
+        target_size = ImageFetcher.fit_size(img.size, width, height)
+        if target_size == img.size:
+            img.load()
+            return img
+        if img.format == "JPEG":
+            img.draft(img.mode, target_size)
+        img.load()
+        return img.resize(target_size, Image.LANCZOS, reducing_gap=2.0)
+
+    def fetch(self, url, token: CancellationToken = None, on_chunk=None, on_request=None):
+        """
+        fetches image from web
+        :param url: image url
+        :param token: cancelling it aborts the download
+        :param on_chunk: called with StreamingDownload after every received chunk
+        :param on_request: called right before the request is sent. Fresh cache hits send no requests
+        :return: content or error status, url
+        """
+        if token is not None and token.cancelled:
+            return ImageFetcher.StatusCodes.CANCELLED, url
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.begin(url)
+        cached, headers = self.prepare_request(url)
+        if cached is not None and cached.is_fresh:
+            if metrics is not None:
+                metrics.update(url, cached=True, bytes=len(cached.content))
+            return cached.content, url
+
+        download = self.new_download()
+        if on_request is not None:
+            on_request()
+        try:
+            start = time.perf_counter()
+            with self.http_client.stream(url, token=token, headers=headers, timeout=self.timeout) as response:
+                if metrics is not None:
+                    headers_received = time.perf_counter()
+                    metrics.update(url, wait=response.wait_time, connect=response.connect_time,
+                                   ttfb=headers_received - start - response.wait_time - response.connect_time)
+                self.check_host_response(url, response.status_code, response.headers)
+                rejection = download.check_response(response.status_code, response.headers)
+                if rejection is None and 200 <= response.status_code < 300:
+                    for chunk in response.iter_content(StreamingDownload.CHUNK_SIZE):
+                        if token is not None and token.cancelled:
+                            return ImageFetcher.StatusCodes.CANCELLED, url
+                        rejection = download.feed(chunk)
+                        if rejection is not None:
+                            break
+                        if on_chunk is not None:
+                            on_chunk(download)
+                if metrics is not None:
+                    metrics.update(url, download=time.perf_counter() - headers_received, bytes=download.n_bytes)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                requests.exceptions.ChunkedEncodingError):
+            if token is not None and token.cancelled:  # socket was shut down under the request
+                return ImageFetcher.StatusCodes.CANCELLED, url
+            self.host_health.record_failure(url)
+            return self.handle_fetching_error(url, cached, retriable=True)
+        except requests.exceptions.RequestException:  # invalid url, too many redirects, ...
+            return self.handle_fetching_error(url, cached, retriable=False)
+        if token is not None and token.cancelled:
+            return ImageFetcher.StatusCodes.CANCELLED, url
+        if rejection is not None:
+            return rejection, url
+        return self.handle_response(url, cached, response.status_code, response.headers, download.content)
+
+    def check_host_response(self, url, status_code, headers):
+        """
+        updates health of the host of the url by the status of its response
+        """
+        if status_code in self.RETRIABLE_STATUS_CODES:
+            self.host_health.record_failure(url, HostHealth.parse_retry_after(headers.get("Retry-After")))
+        else:
+            self.host_health.record_success(url)
+
+    def new_download(self) -> StreamingDownload:
+        return StreamingDownload(max_bytes=self.max_download_size, max_pixels=self.max_image_pixels)
+
+    def prepare_request(self, url):
+        """
+        :return: cache entry of the url or None, request headers
+        """
+        cached = self.image_cache.lookup(url) if self.image_cache is not None else None
+        if cached is None:
+            return None, self.headers
+        return cached, dict(self.headers or {}, **cached.validators())
+
+    def handle_response(self, url, cached, status_code, headers, content):
+        """
+        :return: content or error status, url
+        """
+        if cached is not None and status_code == 304:
+            self.image_cache.refresh(url, headers)
+            return cached.content, url
+        if status_code >= 400:
+            return self.handle_fetching_error(url, cached, retriable=status_code in self.RETRIABLE_STATUS_CODES)
+        if self.image_cache is not None:
+            self.image_cache.store(url, content, headers)
+        return content, url
+
+    def handle_fetching_error(self, url, cached, retriable):
+        if cached is not None:  # stale entry is still better than nothing
+            return cached.content, url
+        if retriable:
+            return ImageFetcher.StatusCodes.RETRIABLE_FETCHING_ERROR, url
+        return ImageFetcher.StatusCodes.NON_RETRIABLE_FETCHING_ERROR, url
+
+    def process_fetched_data(self, content=None, url=None):
+        """
+        decodes fetched content and prepares its thumbnail. Safe to call outside of the main loop
+        :param url: url of the content. Used by metrics
+        :return: status, thumbnail, img
+        """
+        if isinstance(content, ImageFetcher.StatusCodes):
+            return content, None, None
+
+        try:
+            if self.metrics is None or url is None:
+                img = Image.open(BytesIO(content))
+                thumbnail = self.get_thumbnail(img, content)
+            else:
+                start = time.perf_counter()
+                img = Image.open(BytesIO(content))
+                opened = time.perf_counter()
+                thumbnail = self.get_thumbnail(img, content)
+                self.metrics.update(url, open=opened - start, thumbnail=time.perf_counter() - opened)
+            return ImageFetcher.StatusCodes.NORMAL, thumbnail, img
+        except (IOError, UnicodeError, ValueError, Image.DecompressionBombError):
+            return ImageFetcher.StatusCodes.IMAGE_PROCESSING_ERROR, None, None
+
+    def get_thumbnail(self, img, content: bytes):
+        """
+        prepares display thumbnail of the image or takes it from the image cache
+        """
+        if self.image_cache is None:
+            return self.make_thumbnail(img, width=self.optimal_visual_width, height=self.optimal_visual_height)
+
+        content_hash = ImageCache.content_key(content)
+        thumbnail_data = self.image_cache.get_thumbnail(content_hash,
+                                                        self.optimal_visual_width, self.optimal_visual_height)
+        if thumbnail_data is not None:
+            thumbnail = Image.open(BytesIO(thumbnail_data))
+            thumbnail.load()
+            return thumbnail
+
+        thumbnail = self.make_thumbnail(img, width=self.optimal_visual_width, height=self.optimal_visual_height)
+        try:
+            self.image_cache.store_thumbnail(content_hash, self.optimal_visual_width, self.optimal_visual_height,
+                                             thumbnail)
+        except (IOError, ValueError):  # mode can't be written as png
+            pass
+        return thumbnail
+
+    @staticmethod
+    def image_hash(img) -> int:
+        """
+        64-bit difference hash: whether each pixel of 9x8 grayscale image is brighter than its right neighbour
+        """
+        small = img.convert("L").resize((9, 8), Image.BILINEAR)
+        differences = ImageChops.subtract(small.crop((0, 0, 8, 8)), small.crop((1, 0, 9, 8)))
+        return int.from_bytes(differences.point(lambda p: 255 if p else 0, "1").tobytes(), "big")
+
+    def saving_name(self, url) -> str:
+        """
+        saving name of the image fetched from url. Stays the same between runs
+        """
+        return self.image_saving_name_pattern.format(int(hashlib.sha1(url.encode()).hexdigest()[:15], 16))
+
+    def write_image(self, content: bytes, saving_path_base) -> str:
+        """
+        saves image within saving size limits in saving format. Image bytes are written as is
+        when the image needs neither resizing nor format conversion
+        :param saving_path_base: saving path without extension
+        :return: saving path
+        """
+        extension = self.SAVING_EXTENSIONS.get(self.saving_image_format, self.saving_image_format.lower())
+        saving_path = f"{saving_path_base}.{extension}"
+        img = Image.open(BytesIO(content))
+        if img.format == self.saving_image_format and \
+                self.fit_size(img.size, self.optimal_result_width, self.optimal_result_height) == img.size:
+            _write_atomic(saving_path, content)
+            return saving_path
+
+        saving_image = self.prepare_image(img, width=self.optimal_result_width, height=self.optimal_result_height)
+        if self.saving_image_format == "JPEG" and saving_image.mode not in ("RGB", "L", "CMYK"):
+            saving_image = saving_image.convert("RGB")
+        buffer = BytesIO()
+        saving_image.save(buffer, format=self.saving_image_format, quality=self.saving_image_quality)
+        _write_atomic(saving_path, buffer.getvalue())
+        return saving_path
+
+
+class ImageSearch(ImageFetcher, Toplevel):
+    PICKED_BUTTON_BG = "#FF0000"
+    PLACEHOLDER_BG = "#DDDDDD"
+    PLACEHOLDER_SIZE = 150
+
+    def __init__(self, master, search_term, saving_dir, **kwargs):
+        """
+        master: \n
+        search_term: \n
+        saving_dir: \n
+        url_scrapper: function that returns image urls by given query. Runs on a background thread and may return
+            a list, a generator, an async iterator or a paged callback (see URLSource). Urls are shown as soon as
+            they are scrapped\n
+        query_cache: QueryCache that keeps url lists of queries (see CachedURLScrapper) and remembers shown pages,
+            scroll position and chosen images of every query, so that returning to a query resumes it\n
+        max_request_tries: how many retries allowed per one image-showing cycle\n
+        max_retries: how many times url that failed with retriable error is retried. Retries are delayed with
+            jittered exponential backoff starting from retry_base_delay up to retry_max_delay seconds\n
+        host_health: HostHealth tracking failures of hosts. Urls of failing hosts are deferred,
+            urls of dead hosts are skipped. Shared HostHealth.default() by default\n
+        poll_interval: how often (ms) fetched images are collected by the main loop\n
+        prefetch_depth: how many next pages are fetched in the background while the current one is browsed\n
+        progressive_previews: show coarse preview of progressive JPEG as soon as its first scan is downloaded.
+            Slots of the requested images are reserved at once and show placeholders until images are ready\n
+        dedup_threshold: images whose perceptual hash is within this Hamming distance (of 64 bits) from an already
+            shown image are skipped. None disables deduplication\n
+        init_urls: custom urls to be displayed\n
+        headers: request headers\n
+        http_client: HTTPClient used for fetching. Shared HTTPClient.default() is used if none of
+            http_client, max_connections, max_connections_per_host, http_retries are given\n
+        max_connections: maximum number of simultaneous requests of this window\n
+        max_connections_per_host: maximum number of simultaneous requests to one host\n
+        http_retries: how many times failed connections are retried by the http client\n
+        fetch_backend: "threads" (default) to fetch on the process-wide ThreadFetchBackend, "asyncio" to use
+            the process-wide AsyncioFetchBackend (requires aiohttp), or a backend instance. Windows sharing
+            a backend take turns, images of the shown pages go before prefetched ones. Number of fetches in
+            flight adapts to latency and errors of the backend (see AdaptiveConcurrency)\n
+        image_cache: ImageCache instance used to keep fetched images and thumbnails between sessions\n
+        image_memory_limit: how many bytes of fetched images are kept in memory before spilling them to disk\n
+        decode_processes: True to decode images and prepare their thumbnails on the process-wide
+            DecodeProcessPool, or a pool instance. Images are decoded by fetching threads by default\n
+        timeout: request timeout\n
+        max_download_size: downloads larger than this many bytes are aborted\n
+        max_image_pixels: images with more pixels are rejected as soon as their header is fetched\n
+        show_image_width: maximum image display width\n
+        show_image_height: maximum image display height\n
+        saving_image_width: maximum image saving width\n
+        saving_image_height: maximum image saving height\n
+        saving_image_format: format of saved images: "png" (default), "jpeg", "webp", ...\n
+        saving_image_quality: quality of lossy saving formats\n
+        saving_workers: number of threads that save images\n
+        image_saving_name_pattern: modifies saving name. example: "this_image_{}"\n
+        metrics: True or FetchMetrics instance to record per-url stage timings. Disabled by default\n
+        debug_overlay: show stage timings of the metrics at the bottom of the window\n
+        n_images_in_row: \n
+        n_rows: \n
+        virtualized_grid: create buttons only for the rows near the visible area and reuse them while scrolling.
+            All cells get the size of the largest thumbnail\n
+        button_padx: \n
+        button_pady: \n
+        window_width_limit: maximum width of the window\n
+        window_height_limit: maximum height of the window\n
+        window_bg: window background color\n
+        entry_params(**kwargs)s: entry widget params\n
+        command_button_params(**kwargs): "Show more" and "Download" buttons params\n
+        on_close_action(**kwargs): additional action performed on closing.
+        """
+        preload_modules()
+        self.search_term = search_term
+        self.img_urls = URLFrontier(kwargs.get("init_urls", []))
+        self.url_scrapper = kwargs.get("url_scrapper")
+        self.query_cache = kwargs.get("query_cache")
+        if self.query_cache is not None and self.url_scrapper is not None and \
+                not isinstance(self.url_scrapper, CachedURLScrapper):
+            self.url_scrapper = CachedURLScrapper(self.url_scrapper, self.query_cache)
+        self.url_source = None
+        self.awaited_slots = []  # cells of the shown pages waiting for the scrapper
+        if self.search_term and self.url_scrapper is not None:
+            self.url_source = URLSource(self.url_scrapper, self.search_term).start()
+        self.resumed_pages = 1
+        self.resumed_scroll = None
+        self.resumed_selection = set()  # urls of the chosen images of the previous visit of the query
+
+        self.button_bg = self.activebackground = "#FFFFFF"
+        self.window_bg = kwargs.get("window_bg", "#F0F0F0")
+        self.command_button_params = kwargs.get("command_button_params", {})
+        self.entry_params = kwargs.get("entry_params", {})
+        self.button_padx = kwargs.get("button_padx", 10)
+        self.button_pady = kwargs.get("button_pady", 10)
+        Toplevel.__init__(self, master, bg=self.window_bg)
+
+        ImageFetcher.__init__(self, **kwargs)
+        self.saving_dir = saving_dir
+
+        self.max_request_tries = kwargs.get("max_request_tries", 1)
+
+        self.last_button_row = 0
+        self.last_button_column = 0
+        self.last_button_index = 0
+        self.n_images_in_row = kwargs.get("n_images_in_row", 3)
+        self.n_rows = kwargs.get("n_rows", 5)
+        self.n_images_per_cycle = self.n_rows * self.n_images_in_row
+        self.virtualized_grid = kwargs.get("virtualized_grid", False)
+        self.buttons = []
+        self.thumbnails = []
+        self.max_thumbnail_size = (1, 1)
+        self.button_chrome = None
+        self.slots = []  # saving index of the image shown in every cell of the grid, None for unfilled cells
+        self.free_slots = []  # heap of cells left by failed fetches
+        self.url_slots = {}  # {url: reserved cell} of the shown pages
+        self.n_shown = 0
+        self.fit_grid_id = None
+        self.progressive_previews = kwargs.get("progressive_previews", True)
+        # Tk image, so that the grid skeleton is drawn before PIL is imported
+        self.placeholder_size = (self.optimal_visual_width or self.optimal_visual_height or self.PLACEHOLDER_SIZE,
+                                 self.optimal_visual_height or self.optimal_visual_width or self.PLACEHOLDER_SIZE)
+        self.placeholder_photo = PhotoImage(width=self.placeholder_size[0], height=self.placeholder_size[1])
+        self.placeholder_photo.put(self.PLACEHOLDER_BG, to=(0, 0) + self.placeholder_size)
+
+        fetch_backend = kwargs.get("fetch_backend", "threads")
+        if fetch_backend == "threads":
+            self.fetch_backend = ThreadFetchBackend.default()
+        elif fetch_backend == "asyncio":
+            self.fetch_backend = AsyncioFetchBackend.default()
+        else:
+            self.fetch_backend = fetch_backend
+        self.fetch_backend.register(self)
+        self.results_queue = Queue()
+        self.cancel_token = CancellationToken()  # cancelled when the search is restarted or the window is closed
+        self.active_batches = {}  # batches with fetches in flight in order of submission (dict as ordered set)
+        self.poll_interval = kwargs.get("poll_interval", 20)
+        self.polling_id = None
+
+        self.prefetch_depth = kwargs.get("prefetch_depth", 0)
+        self.prefetched = deque()  # FetchResults of the next pages
+        self.prefetch_hits = 0
+        self.prefetch_misses = 0
+
+        self.dedup_threshold = kwargs.get("dedup_threshold")
+        self.image_hashes = HammingIndex()
+        decode_processes = kwargs.get("decode_processes")
+        self.decode_processes = DecodeProcessPool.default() if decode_processes is True else decode_processes
+        self.duplicates_skipped = 0
+
+        self.saving_images = ImageStore(max_bytes=kwargs.get("image_memory_limit", 64 * 2 ** 20))
+        self.saving_images_names = []
+        self.saving_indices = []
+        self.shown_urls = []  # url of every shown image, None for dropped local files
+
+        self.drop_batches = set()
+        self.dropped_paths = set()  # local files imported by the current query
+        self.n_dropped = 0
+        self.n_dropped_done = 0
+
+        self.saving_workers = kwargs.get("saving_workers", os.cpu_count())
+        self.saving_pool = None
+        self.saving_futures = None
+        self.saving_tracking_id = None
 
         self.title("Image search")
         self.search_field = Entry(self, justify="center", **self.entry_params)
@@ -437,7 +3109,7 @@ class ImageSearch(Toplevel):
         self.sf = ScrolledFrame(self, scrollbars="both")
         self.sf.grid(row=1, column=0, columnspan=2)
         self.sf.bind_scroll_wheel(self)
-        self.inner_frame = self.sf.display_widget(partial(Frame, bg=self.window_bg))
+        self.create_grid()
 
         window_width_limit = kwargs.get("window_width_limit")
         window_height_limit = kwargs.get("window_height_limit")
@@ -446,14 +3118,21 @@ class ImageSearch(Toplevel):
         self.window_height_limit = window_height_limit if window_height_limit is not None else \
             master.winfo_screenheight() * 2 // 3
 
-        self.show_more_gen = self.show_more()
-
         self.show_more_button = Button(master=self, text="Show more",
-                                       command=lambda x=self.show_more_gen: next(x), **self.command_button_params)
+                                       command=self.show_more, **self.command_button_params)
         self.download_button = Button(master=self, text="Download",
                                  command=lambda: self.close_image_search(), **self.command_button_params)
         self.show_more_button.grid(row=3, column=0, sticky="news")
         self.download_button.grid(row=3, column=1, sticky="news")
+        self.saving_progress = Progressbar(self, orient="horizontal", mode="determinate")
+        self.drop_progress = Progressbar(self, orient="horizontal", mode="determinate")
+
+        self.debug_overlay = None
+        self.debug_overlay_id = None
+        if kwargs.get("debug_overlay") and self.metrics is not None:
+            self.debug_overlay = Label(self, anchor="w", justify="left", font="TkFixedFont", bg=self.window_bg)
+            self.debug_overlay.grid(row=4, column=0, columnspan=2, sticky="news")
+            self.update_debug_overlay()
 
         self.on_closing_action = kwargs.get("on_close_action")
 
@@ -464,196 +3143,1030 @@ class ImageSearch(Toplevel):
 
         self.drop_target_register(DND_FILES, DND_TEXT)
         self.dnd_bind('<<Drop>>', self.drop)
+        self.load_query_state()
 
     def start(self):
-        if hasattr(self, "show_more_gen"):  # checks whether current instance has images to fetch
-            next(self.show_more_gen)
+        """
+        reserves the first page (or the pages shown during the previous visit of the query) and starts their fetches.
+        Doesn't wait for the window to be drawn: placeholders are shown with the window in the first frame
+        """
+        for _ in range(self.resumed_pages):
+            self.show_more()
+
+    @property
+    def command_widget_total_height(self):
+        return self.download_button.winfo_reqheight() + self.search_field.winfo_reqheight() + 2 * self.button_pady
 
     def restart_search(self):
-        self.search_term = self.search_field.get()
-        if not self.search_term:
+        search_term = self.search_field.get()
+        if not search_term:
             messagebox.showerror(message="Empty search query")
             return
+        self.save_query_state()
+        self.search_term = search_term
 
-        try:
-            self.img_urls = Deque(self.url_scrapper(self.search_term))
-        except ConnectionError:
-            messagebox.showerror(message="Check your internet connection")
-            return
+        if self.url_source is not None:
+            self.url_source.close()
+        self.url_source = URLSource(self.url_scrapper, self.search_term).start()
+        self.img_urls = URLFrontier()
+        self.awaited_slots = []
 
-        self.saving_images = []
+        self.saving_images.clear()
         self.saving_images_names = []
         self.saving_indices = []
+        self.shown_urls = []
+
+        # downloads of the previous query are aborted, results that are still in flight are dropped
+        self.cancel_token.cancel()
+        self.cancel_token = CancellationToken()
+        self.fetch_backend.cancel(self)
+        self.active_batches = {}
+        self.drop_batches = set()
+        self.dropped_paths = set()
+        self.update_drop_progress()
+        self.prefetched.clear()
+        self.retry_scheduler.clear()
+        self.image_hashes = HammingIndex()
+
+        self.create_grid()
+        self.load_query_state()
+        self.start()
+
+    def save_query_state(self):
+        """
+        remembers shown pages, scroll position and chosen images of the current query in query_cache
+        """
+        if self.query_cache is None or not self.search_term or self.url_source is None:
+            return
+        n_reserved_slots = len(self.slots) - len(self.free_slots)
+        self.query_cache.save_state(self.search_term, {
+            "pages": max(1, -(-n_reserved_slots // self.n_images_per_cycle)),
+            "scroll": self.sf.yview()[0],
+            "selected": [self.shown_urls[i] for i in self.saving_indices if self.shown_urls[i] is not None]})
 
-        self.last_button_row = 0
-        self.last_button_column = 0
-        self.last_button_index = 0
-
-        self.show_more_gen = self.show_more()
-        self.show_more_button.configure(command=lambda x=self.show_more_gen: next(x))
-
-        self.inner_frame = self.sf.display_widget(partial(Frame, bg=self.window_bg))
-        if self.img_urls:
-            self.show_more_button["state"] = NORMAL
-            next(self.show_more_gen)
-        else:
-            self.show_more_button["state"] = DISABLED
+    def load_query_state(self):
+        """
+        prepares resuming of the current query from the state saved by save_query_state
+        """
+        state = self.query_cache.load_state(self.search_term) \
+            if self.query_cache is not None and self.search_term and self.url_source is not None else None
+        self.resumed_pages = state["pages"] if state is not None else 1
+        self.resumed_scroll = state["scroll"] if state is not None and state["scroll"] else None
+        self.resumed_selection = set(state["selected"]) if state is not None else set()
 
     def destroy(self):
+        self.save_query_state()
+        self.cancel_token.cancel()
+        if self.saving_pool is not None:  # closed while saving: writes that have started finish in the background
+            self.saving_pool.shutdown(wait=False, cancel_futures=True)
+            self.saving_pool = None
+        if self.saving_tracking_id is not None:
+            self.after_cancel(self.saving_tracking_id)
+            self.saving_tracking_id = None
+        if self.polling_id is not None:
+            self.after_cancel(self.polling_id)
+            self.polling_id = None
+        if self.debug_overlay_id is not None:
+            self.after_cancel(self.debug_overlay_id)
+            self.debug_overlay_id = None
+        if self.fit_grid_id is not None:
+            self.after_cancel(self.fit_grid_id)
+            self.fit_grid_id = None
+        if self.url_source is not None:
+            self.url_source.close()
+        self.fetch_backend.unregister(self)
+        self.active_batches = {}
         if self.on_closing_action is not None:
             self.on_closing_action(self)
+        running_saves = [future for future in self.saving_futures or () if not future.done()]
+        if running_saves:  # stored images are released once the writes that read them are finished
+            threading.Thread(target=lambda: (wait(running_saves), self.saving_images.clear()), daemon=True).start()
+        else:
+            self.saving_images.clear()
+        self.close_fetching()
         super(ImageSearch, self).destroy()
 
     def close_image_search(self):
-        for saving_index in self.saving_indices:
-            saving_image = self.prepare_image(self.saving_images[saving_index],
-                                              width=self.optimal_result_width,
-                                              height=self.optimal_result_height)
-            saving_image.save(f"{self.saving_dir}/{self.saving_images_names[saving_index]}.png")
+        """
+        saves chosen images on the background pool and closes the window when all of them are saved
+        """
+        if self.saving_futures is not None:  # already saving
+            return
+        if not self.saving_indices:
+            self.destroy()
+            return
+
+        self.show_more_button["state"] = DISABLED
+        self.download_button["state"] = DISABLED
+        self.start_search_button["state"] = DISABLED
+        self.saving_progress.configure(maximum=len(self.saving_indices), value=0)
+        self.drop_progress.grid_remove()
+        self.saving_progress.grid(row=2, column=0, columnspan=2, sticky="news")
+
+        self.saving_pool = ThreadPoolExecutor(max_workers=self.saving_workers)
+        self.saving_futures = [self.saving_pool.submit(self.save_image, saving_index)
+                               for saving_index in self.saving_indices]
+        self.saving_tracking_id = self.after(self.poll_interval, self.track_saving)
+
+    def track_saving(self):
+        self.saving_tracking_id = None
+        n_saved = sum(future.done() for future in self.saving_futures)
+        self.saving_progress["value"] = n_saved
+        if n_saved < len(self.saving_futures):
+            self.saving_tracking_id = self.after(self.poll_interval, self.track_saving)
+            return
+
+        self.saving_pool.shutdown(wait=False)
+        self.saving_pool = None
+        n_failed = sum(future.exception() is not None for future in self.saving_futures)
+        if n_failed:
+            messagebox.showerror(message=f"Couldn't save {n_failed} of {len(self.saving_futures)} images")
         self.destroy()
 
-    @staticmethod
-    def prepare_image(img, width: int = None, height: int = None):
-        processed_img = copy.copy(img)
-        if width is not None and processed_img.width > width:
-            k_width = width / processed_img.width
-            processed_img = processed_img.resize((width, int(processed_img.height * k_width)),
-                                                 Image.ANTIALIAS)
+    def save_image(self, saving_index):
+        """
+        saves stored image
+        """
+        self.write_image(self.saving_images.get_bytes(saving_index),
+                         f"{self.saving_dir}/{self.saving_images_names[saving_index]}")
 
-        if height is not None and processed_img.height > height:
-            k_height = height / processed_img.height
-            processed_img = processed_img.resize((int(processed_img.width * k_height), height),
-                                                 Image.ANTIALIAS)
-        return processed_img
+    def fetch_and_process(self, url, batch: FetchBatch):
+        """
+        worker part of the pipeline. Result is handed over to the main loop through results_queue
+        """
+        content, url = self.fetch_item(url, batch)
+        self.process_and_enqueue(content, url, batch)
 
-    def fetch(self, url):
+    def fetch_item(self, url, batch: FetchBatch, on_request=None):
         """
-        fetches image from web
-        :param url: image url
-        :return: status, button_img, img
+        :param on_request: see fetch
+        :return: content or error status, final url
         """
-        try:
-            response = requests.get(url, headers=self.headers, timeout=self.timeout)
-            response.raise_for_status()
-            content = response.content
-            return content, url
-        except ConnectTimeout:
-            return ImageSearch.StatusCodes.RETRIABLE_FETCHING_ERROR, url
-        except RequestException:
-            return ImageSearch.StatusCodes.NON_RETRIABLE_FETCHING_ERROR, url
-
-    def process_fetched_data(self, content=None):
-        if content == ImageSearch.StatusCodes.RETRIABLE_FETCHING_ERROR:
-            return ImageSearch.StatusCodes.RETRIABLE_FETCHING_ERROR, None, None
-        elif content == ImageSearch.StatusCodes.NON_RETRIABLE_FETCHING_ERROR:
-            return ImageSearch.StatusCodes.NON_RETRIABLE_FETCHING_ERROR, None, None
+        if batch.local:
+            return self.read_file(url), url
+        return self.fetch(url, batch.token, self.preview_handler(url, batch), on_request)
 
+    @staticmethod
+    def read_file(path):
+        """
+        :return: content of the local file or error status
+        """
         try:
-            img = Image.open(BytesIO(content))
-            button_img = ImageTk.PhotoImage(
-                self.prepare_image(img, width=self.optimal_visual_width, height=self.optimal_visual_height))
-            return ImageSearch.StatusCodes.NORMAL, button_img, img
-        except (IOError, UnicodeError):
-            return ImageSearch.StatusCodes.IMAGE_PROCESSING_ERROR, None, None
-
-    def get_images(self, url_batch: list):
-        image_fetch_tasks = []
-        for url in url_batch:
-            image_fetch_tasks.append(self.pool.submit(self.fetch, url))
-        return image_fetch_tasks
-
-    def process_batch(self, step, request_depth=0):
-        def add_fetching_to_queue():
-            nonlocal request_depth
-            if self.img_urls and request_depth < self.max_request_tries:
-                image_data_batch.append(self.pool.submit(self.fetch, self.img_urls.popleft()[0]))
-                request_depth += 1
-
-        button_images_batch = []
-        url_batch = self.img_urls.popleft(step)
-        image_data_batch = self.get_images(url_batch)
-
-        while image_data_batch:
-            image_future = image_data_batch.pop(0)
-            content, url = image_future.result()
-            hash_url = hash(url)
-            status, button_img, img = self.process_fetched_data(content)
-            if status == ImageSearch.StatusCodes.NORMAL:
-                button_images_batch.append(button_img)
-                self.saving_images.append(img)
-                self.saving_images_names.append(self.image_saving_name_pattern.format(hash_url))
-            elif status == ImageSearch.StatusCodes.RETRIABLE_FETCHING_ERROR:
-                self.img_urls.append(url)
-                add_fetching_to_queue()
+            with open(path, "rb") as f:
+                return f.read()
+        except OSError:
+            return ImageSearch.StatusCodes.NON_RETRIABLE_FETCHING_ERROR
+
+    def preview_handler(self, url, batch: FetchBatch):
+        """
+        :return: on_chunk callback of fetch that hands preview of the url over to the main loop,
+            None if the url isn't shown right away
+        """
+        if not self.progressive_previews or batch.prefetch:
+            return None
+
+        def enqueue_preview(download: StreamingDownload):
+            preview = download.take_preview(self.optimal_visual_width, self.optimal_visual_height)
+            if preview is not None and not batch.cancelled:
+                self.results_queue.put(FetchResult(batch, url, ImageSearch.StatusCodes.NORMAL, preview, None, None,
+                                                   preview=True))
+        return enqueue_preview
+
+    def process_and_enqueue(self, content, url, batch: FetchBatch):
+        if batch.cancelled:  # stale work of the previous query or of the closed window
+            return
+        if self.decode_processes is not None:
+            status, thumbnail, image_hash = self.process_in_decode_processes(content, url)
+        else:
+            status, thumbnail, _ = self.process_fetched_data(content, url)
+            image_hash = None
+            if status == ImageSearch.StatusCodes.NORMAL and self.dedup_threshold is not None:
+                image_hash = self.image_hash(thumbnail)
+        self.results_queue.put(FetchResult(batch, url, status, thumbnail, content, image_hash))
+
+    def enqueue_failure(self, url, batch: FetchBatch):
+        """
+        fails the url whose fetching or processing raised, so that its cell is refilled or released
+        """
+        if batch.cancelled:
+            return
+        self.results_queue.put(FetchResult(batch, url, ImageSearch.StatusCodes.NON_RETRIABLE_FETCHING_ERROR,
+                                           None, None, None))
+
+    def process_in_decode_processes(self, content, url):
+        """
+        process_fetched_data on decode_processes. Thumbnails of the image cache are used as they are
+        :return: status, thumbnail, image hash
+        """
+        if isinstance(content, ImageSearch.StatusCodes):
+            return content, None, None
+        with_hash = self.dedup_threshold is not None
+        content_hash = None
+        if self.image_cache is not None:
+            content_hash = ImageCache.content_key(content)
+            thumbnail_data = self.image_cache.get_thumbnail(content_hash,
+                                                            self.optimal_visual_width, self.optimal_visual_height)
+            if thumbnail_data is not None:
+                thumbnail = Image.open(BytesIO(thumbnail_data))
+                thumbnail.load()
+                return ImageSearch.StatusCodes.NORMAL, thumbnail, self.image_hash(thumbnail) if with_hash else None
+
+        start = time.perf_counter()
+        status, thumbnail, image_hash = self.decode_processes.decode(content, self.optimal_visual_width,
+                                                                     self.optimal_visual_height, with_hash)
+        if self.metrics is not None and url is not None:
+            self.metrics.update(url, thumbnail=time.perf_counter() - start)
+        if content_hash is not None and status == ImageSearch.StatusCodes.NORMAL:
+            try:
+                self.image_cache.store_thumbnail(content_hash, self.optimal_visual_width, self.optimal_visual_height,
+                                                 thumbnail)
+            except (IOError, ValueError):  # mode can't be written as png
+                pass
+        return status, thumbnail, image_hash
+
+    def is_duplicate(self, result: FetchResult) -> bool:
+        """
+        checks result against the images of the session and remembers it if it is new
+        """
+        if result.image_hash is None:
+            return False
+        if self.image_hashes.find(result.image_hash, self.dedup_threshold) is not None:
+            self.duplicates_skipped += 1
+            return True
+        self.image_hashes.add(result.image_hash)
+        return False
+
+    def submit_fetch(self, url, batch: FetchBatch):
+        batch.n_pending += 1
+        batch.urls.add(url)
+        self.fetch_backend.submit(self, url, batch, priority=FetchBackend.PREFETCH_PRIORITY if batch.prefetch
+                                  else FetchBackend.VISIBLE_PRIORITY)
+
+    def process_batch(self, step, request_depth=0, prefetch=False, slots=()):
+        """
+        starts fetching of the next `step` images without waiting for them.
+        Images are shown by poll_results in the order they are ready
+        :param slots: cells already reserved for the images. Cells for the rest of them are reserved here.
+            Cells of the images that the scrapper hasn't found yet wait for it, unless it is exhausted
+        :return: started batch
+        """
+        batch = FetchBatch(tries_left=0 if prefetch else self.max_request_tries - request_depth, prefetch=prefetch,
+                           token=self.cancel_token)
+        slots = deque(slots)
+        for url in self.next_urls(step):
+            if not prefetch:
+                self.url_slots[url] = slots.popleft() if slots else self.reserve_slot()
+            self.submit_fetch(url, batch)
+        if not prefetch and self.url_source is not None and not self.url_source.exhausted:
+            while len(slots) < step - batch.n_pending:
+                slots.append(self.reserve_slot())
+            self.awaited_slots.extend(slots)
+        else:
+            for slot in slots:
+                self.release_slot(slot)
+        if batch.n_pending:
+            self.active_batches[batch] = None
+        if batch.n_pending or self.awaited_slots:
+            self.schedule_polling()
+        return batch
+
+    def next_urls(self, n) -> list:
+        """
+        takes up to n urls to fetch: retries that are due first, then queued urls.
+        Urls of hosts with tripped circuit breakers are deferred until the hosts recover,
+        urls of dead hosts are dropped
+        """
+        candidates = deque(url for url, _ in self.retry_scheduler.pop_ready(n))
+        urls = []
+        while len(urls) < n:
+            if not candidates and not self.img_urls and not self.pull_urls(n - len(urls)):
+                break
+            url = candidates.popleft() if candidates else self.img_urls.popleft()[0]
+            if self.host_health.is_dead(url):
+                continue
+            if self.host_health.acquire(url):
+                urls.append(url)
+            else:
+                self.retry_scheduler.defer(url)
+        for url in candidates:
+            self.retry_scheduler.defer(url)
+        return urls
+
+    def pull_urls(self, n) -> int:
+        """
+        moves up to n urls that are already scrapped to the frontier
+        :return: number of queued urls
+        """
+        if self.url_source is None:
+            return 0
+        while True:
+            urls = self.url_source.take(n)
+            if not urls or self.img_urls.extend(urls):
+                return len(self.img_urls)
+
+    @property
+    def n_pending_fetches(self):
+        """
+        number of images of the shown pages that are still being fetched
+        """
+        return sum(batch.n_pending for batch in self.active_batches if not batch.prefetch)
+
+    def prefetch(self):
+        """
+        tops up fetched and in-flight images of the next prefetch_depth pages.
+        Each url gets its own batch so that it can be promoted to the shown page separately
+        """
+        n_prefetching = sum(batch.n_pending for batch in self.active_batches if batch.prefetch)
+        n_missing = self.prefetch_depth * self.n_images_per_cycle - len(self.prefetched) - n_prefetching
+        for _ in range(max(n_missing, 0)):
+            if not self.process_batch(1, prefetch=True).n_pending:
+                break
+
+    def take_prefetched(self, n) -> int:
+        """
+        shows up to n buffered images and promotes in-flight prefetch batches, oldest first, to make up the rest
+        :return: number of images taken
+        """
+        n_buffered = 0
+        while self.prefetched and n_buffered < n:
+            result = self.prefetched.popleft()
+            self.fill_slot(self.reserve_slot(), result.thumbnail, self.add_saving_image(result.url, result.content))
+            n_buffered += 1
+        self.prefetch_hits += n_buffered
+
+        n_taken = n_buffered
+        for batch in self.active_batches:
+            if n_taken == n:
+                break
+            if batch.prefetch:
+                batch.prefetch = False
+                self.fetch_backend.promote(self, batch)
+                for url in batch.urls:
+                    self.url_slots[url] = self.reserve_slot()
+                n_taken += batch.n_pending
+        self.prefetch_misses += n - n_buffered
+        return n_taken
+
+    def prefetch_stats(self) -> dict:
+        return {"depth": self.prefetch_depth,
+                "buffered": len(self.prefetched),
+                "hits": self.prefetch_hits,
+                "misses": self.prefetch_misses}
+
+    def add_saving_image(self, url, content) -> int:
+        """
+        :return: saving index of the image
+        """
+        self.saving_images.add(content=content)
+        self.saving_images_names.append(self.saving_name(url))
+        self.shown_urls.append(url)
+        saving_index = len(self.saving_images_names) - 1
+        if url in self.resumed_selection:
+            self.resumed_selection.discard(url)
+            self.saving_indices.append(saving_index)
+        return saving_index
+
+    def add_dropped_file(self, path) -> int:
+        """
+        dropped files are saved from their paths instead of being kept in memory
+        :return: saving index of the image
+        """
+        self.saving_images.add(path=path)
+        self.saving_images_names.append(self.saving_name(path))
+        self.shown_urls.append(None)
+        return len(self.saving_images_names) - 1
+
+    def stats(self) -> dict:
+        """
+        :return: stage timing histograms (if metrics are enabled), connection, host health, frontier,
+            prefetch, deduplication and image store (resident bytes, spills to disk) statistics of the window
+        """
+        return {"metrics": self.metrics.stats() if self.metrics is not None else None,
+                "http": self.http_client.stats(),
+                "fetch_backend": self.fetch_backend.stats(),
+                "decode_processes": self.decode_processes.stats() if self.decode_processes is not None else None,
+                "hosts": self.host_health.report(),
+                "retries_pending": len(self.retry_scheduler),
+                "frontier": self.img_urls.stats(),
+                "prefetch": self.prefetch_stats(),
+                "duplicates_skipped": self.duplicates_skipped,
+                "shown": self.n_shown,
+                "chosen": len(self.saving_indices),
+                "image_store": self.saving_images.stats()}
+
+    def export_stats(self, path, export_format=None):
+        """
+        writes per-url records of the metrics to a json or csv file. See FetchMetrics.export
+        """
+        if self.metrics is None:
+            raise ValueError("metrics are disabled")
+        self.metrics.export(path, export_format)
+
+    def update_debug_overlay(self):
+        self.debug_overlay["text"] = f"{self.metrics.summary()}\n" \
+                                     f"shown {self.n_shown}  pending {self.n_pending_fetches}  " \
+                                     f"queued {len(self.img_urls)}  prefetched {len(self.prefetched)}  " \
+                                     f"limit {self.fetch_backend.concurrency.limit}"
+        self.debug_overlay_id = self.after(1000, self.update_debug_overlay)
+
+    def update_show_more_state(self):
+        if self.saving_futures is not None:  # window is closing, close_image_search disabled the button
+            return
+        has_more = self.img_urls or self.prefetched or self.retry_scheduler or \
+            self.url_source is not None and not self.url_source.exhausted
+        self.show_more_button["state"] = NORMAL if has_more else DISABLED
+
+    def schedule_polling(self):
+        if self.polling_id is None:
+            self.polling_id = self.after(self.poll_interval, self.poll_results)
+
+    def poll_results(self):
+        self.polling_id = None
+        if self.url_source is not None:
+            error = self.url_source.take_error()
+            if isinstance(error, requests.exceptions.ConnectionError):
+                messagebox.showerror(message="Check your internet connection")
+            elif error is not None:
+                messagebox.showerror(message=f"Couldn't get image urls: {error}")
+        if self.awaited_slots:
+            awaited_slots, self.awaited_slots = self.awaited_slots, []
+            self.process_batch(len(awaited_slots), slots=awaited_slots)
+
+        while True:
+            try:
+                result = self.results_queue.get_nowait()
+            except Empty:
+                break
+            batch = result.batch
+            if batch.cancelled or batch not in self.active_batches:  # stale result of the previous query
+                continue
+            if result.preview:
+                if result.url in self.url_slots:
+                    self.show_in_slot(self.url_slots[result.url], result.thumbnail)
+                continue
+
+            batch.n_pending -= 1
+            batch.urls.discard(result.url)
+            slot = self.url_slots.pop(result.url, None)
+            status = result.status
+            if status == ImageSearch.StatusCodes.NORMAL and self.is_duplicate(result):
+                status = ImageSearch.StatusCodes.DUPLICATE_IMAGE
+            if self.metrics is not None:
+                self.metrics.finish(result.url, status)
+
+            if status == ImageSearch.StatusCodes.NORMAL and batch.prefetch:
+                self.prefetched.append(result)
+            elif status == ImageSearch.StatusCodes.NORMAL:
+                self.fill_slot(slot if slot is not None else self.reserve_slot(), result.thumbnail,
+                               self.add_dropped_file(result.url) if batch.local else
+                               self.add_saving_image(result.url, result.content))
+            elif status == ImageSearch.StatusCodes.DUPLICATE_IMAGE:
+                # duplicates don't use up request tries. Dropped duplicates are just done
+                self.replace_failed(slot, self.next_urls(1) if not batch.prefetch and batch not in self.drop_batches
+                                    else [], batch)
             else:
-                add_fetching_to_queue()
-        return button_images_batch
+                if status == ImageSearch.StatusCodes.RETRIABLE_FETCHING_ERROR:
+                    self.retry_scheduler.schedule(result.url)
+                replacements = self.next_urls(1) if batch.tries_left > 0 else []
+                batch.tries_left -= len(replacements)
+                self.replace_failed(slot, replacements, batch)
+
+            if batch in self.drop_batches:
+                self.n_dropped_done += 1
+            if not batch.n_pending:
+                self.active_batches.pop(batch, None)
+                self.drop_batches.discard(batch)
+
+        if self.n_dropped:
+            self.update_drop_progress()
+        self.update_show_more_state()
+        if self.active_batches or self.awaited_slots:
+            self.schedule_polling()
+
+    def replace_failed(self, slot, urls, batch: FetchBatch):
+        """
+        fetches urls in place of the failed image. The first of them takes its cell,
+        the cell is released if there are none
+        """
+        for url in urls:
+            if slot is not None:
+                self.url_slots[url] = slot
+                slot = None
+            self.submit_fetch(url, batch)
+        if slot is not None:
+            self.release_slot(slot)
+
+    def create_grid(self):
+        self.buttons = []
+        self.thumbnails = []
+        self.max_thumbnail_size = self.placeholder_size
+        self.slots = []
+        self.free_slots = []
+        self.url_slots = {}
+        self.n_shown = 0
+        self.last_button_row = 0
+        self.last_button_column = 0
+        self.last_button_index = 0
+        if not self.virtualized_grid:
+            self.inner_frame = self.sf.display_widget(partial(Frame, bg=self.window_bg))
+            return
+        self.inner_frame = self.sf.display_virtual_grid(n_columns=self.n_images_in_row, cell_width=1, cell_height=1,
+                                                        create_cell=self.create_button,
+                                                        configure_cell=self.configure_button,
+                                                        release_cell=self.release_button,
+                                                        show_cell=lambda slot: slot not in self.free_slots,
+                                                        padx=self.button_padx, pady=self.button_pady,
+                                                        bg=self.window_bg)
+
+    def choose_pic(self, slot):
+        saving_index = self.slots[slot]
+        if saving_index is None:  # image isn't ready yet
+            return
+        if saving_index not in self.saving_indices:
+            self.saving_indices.append(saving_index)
+        else:
+            self.saving_indices.remove(saving_index)
 
-    def choose_pic(self, button):
-        if not button.is_picked:
-            button["bg"] = "#FF0000"
-            self.saving_indices.append(button.image_index)
+        if self.virtualized_grid:
+            self.sf.refresh_virtual_grid(slot)
         else:
-            button["bg"] = self.button_bg
-            self.saving_indices.remove(button.image_index)
-        button.is_picked = not button.is_picked
-
-    def create_buttons(self, button_image_batch):
-        for j in range(len(button_image_batch)):
-            b = Button(master=self.inner_frame, image=button_image_batch[j],
-                       bg=self.button_bg, activebackground=self.activebackground)
-            b.image = button_image_batch[j]
-            b.image_index = self.last_button_index
-            b.is_picked = False
-            b["command"] = lambda current_button=b: self.choose_pic(current_button)
-            b.grid(row=self.last_button_index // self.n_images_in_row,
-                   column=self.last_button_index % self.n_images_in_row,
-                   padx=self.button_padx, pady=self.button_pady, sticky="news")
-            self.last_button_index += 1
-        self.last_button_row = self.last_button_index // self.n_images_in_row
-        self.last_button_column = self.last_button_index % self.n_images_in_row
-    
-    def show_button_image_batch(self, button_batch: list):
-        self.create_buttons(button_batch)
-        self.inner_frame.update()
-        current_frame_width = self.inner_frame.winfo_width()
-        current_frame_height = self.inner_frame.winfo_height()
+            self.buttons[slot]["bg"] = self.slot_bg(slot)
+
+    def slot_bg(self, slot):
+        saving_index = self.slots[slot]
+        return self.PICKED_BUTTON_BG if saving_index is not None and saving_index in self.saving_indices \
+            else self.button_bg
+
+    def reserve_slot(self) -> int:
+        """
+        takes the first cell left by a failed image or appends a new one to the grid. Cell shows placeholder
+        :return: index of the cell
+        """
+        if self.free_slots:
+            slot = heapq.heappop(self.free_slots)
+        else:
+            slot = len(self.slots)
+            self.slots.append(None)
+            if self.virtualized_grid:
+                self.thumbnails.append(None)
+            else:
+                self.buttons.append(self.create_button(self.inner_frame))
+            self.last_button_index = len(self.slots)
+            self.last_button_row, self.last_button_column = divmod(self.last_button_index, self.n_images_in_row)
+        self.show_in_slot(slot, None)
+        return slot
+
+    def fill_slot(self, slot, thumbnail, saving_index):
+        self.slots[slot] = saving_index
+        self.n_shown += 1
+        self.show_in_slot(slot, thumbnail)
+
+    def release_slot(self, slot):
+        """
+        leaves the cell of the failed image to the next reserved one. Other cells stay where they are
+        """
+        heapq.heappush(self.free_slots, slot)
+        if self.virtualized_grid:
+            self.show_in_slot(slot, None)
+        else:
+            self.buttons[slot].grid_remove()
+
+    def show_in_slot(self, slot, thumbnail):
+        """
+        shows preview or image in the cell without touching the other ones
+        :param thumbnail: None for placeholder
+        """
+        if self.virtualized_grid:
+            self.thumbnails[slot] = thumbnail
+            if thumbnail is not None and (thumbnail.width > self.max_thumbnail_size[0] or
+                                          thumbnail.height > self.max_thumbnail_size[1]):
+                self.max_thumbnail_size = (max(self.max_thumbnail_size[0], thumbnail.width),
+                                           max(self.max_thumbnail_size[1], thumbnail.height))
+            self.sf.refresh_virtual_grid(slot)
+        else:
+            button = self.buttons[slot]
+            button.image = self.photo_image(slot, thumbnail)
+            button.configure(image=button.image, command=lambda: self.choose_pic(slot), bg=self.slot_bg(slot))
+            button.grid(row=slot // self.n_images_in_row, column=slot % self.n_images_in_row,
+                        padx=self.button_padx, pady=self.button_pady, sticky="news")
+        if self.fit_grid_id is None:
+            self.fit_grid_id = self.after_idle(self.fit_grid)
+
+    def create_button(self, master):
+        button = Button(master=master, bg=self.button_bg, activebackground=self.activebackground)
+        button.image_index = None
+        button.thumbnail = None
+        return button
+
+    def configure_button(self, button, index):
+        """
+        shows cell `index` in the recycled button of the virtual grid
+        """
+        thumbnail = self.thumbnails[index]
+        if button.image_index != index or button.thumbnail is not thumbnail:
+            button.image = self.photo_image(index, thumbnail)
+            button.image_index = index
+            button.thumbnail = thumbnail
+        button.configure(image=button.image, command=lambda: self.choose_pic(index), bg=self.slot_bg(index))
+
+    def photo_image(self, slot, thumbnail):
+        if thumbnail is None:
+            return self.placeholder_photo
+        saving_index = self.slots[slot]
+        if self.metrics is None or saving_index is None or self.shown_urls[saving_index] is None:
+            return ImageTk.PhotoImage(thumbnail)
+        start = time.perf_counter()
+        photo = ImageTk.PhotoImage(thumbnail)
+        self.metrics.update(self.shown_urls[saving_index], photo=time.perf_counter() - start)
+        return photo
+
+    @staticmethod
+    def release_button(button):
+        button.configure(image="")
+        button.image = None
+        button.image_index = None
+        button.thumbnail = None
+
+    def measure_button_chrome(self):
+        """
+        :return: how much wider and higher a button is than its image
+        """
+        probe_image = PhotoImage(width=1, height=1)
+        probe = self.create_button(self)
+        probe.configure(image=probe_image)
+        chrome = probe.winfo_reqwidth() - 1, probe.winfo_reqheight() - 1
+        probe.destroy()
+        return chrome
+
+    def fit_grid(self):
+        """
+        sizes the scrolled area to the grid once per batch of cell changes
+        """
+        self.fit_grid_id = None
+        if self.virtualized_grid:
+            if self.button_chrome is None:
+                self.button_chrome = self.measure_button_chrome()
+            cell_width = self.max_thumbnail_size[0] + self.button_chrome[0] + 2 * self.button_padx
+            cell_height = self.max_thumbnail_size[1] + self.button_chrome[1] + 2 * self.button_pady
+            # free cells at the end collapse like removed buttons of the grid
+            n_cells = len(self.slots)
+            free_slots = set(self.free_slots)
+            while n_cells and n_cells - 1 in free_slots:
+                n_cells -= 1
+            self.sf.set_virtual_grid(n_cells=n_cells, cell_width=cell_width, cell_height=cell_height)
+
+        self.inner_frame.update_idletasks()
+        current_frame_width = self.inner_frame.winfo_reqwidth()
+        current_frame_height = self.inner_frame.winfo_reqheight()
 
         self.sf.config(width=min(self.window_width_limit, current_frame_width),
                        height=min(self.window_height_limit - self.command_widget_total_height, current_frame_height))
-    
-    def show_more(self):
-        self.update()
-        self.command_widget_total_height = self.download_button.winfo_height() + self.search_field.winfo_height() + \
-                                           2 * self.button_pady
+        if self.resumed_scroll is not None:  # grid of the resumed pages is reserved at once
+            self.after_idle(self.sf.yview_moveto, self.resumed_scroll)
+            self.resumed_scroll = None
 
-        button_image_batch = self.process_batch(self.n_images_per_cycle - self.last_button_column)
-        while True:
-            self.show_button_image_batch(button_image_batch)
-            if not self.img_urls:
-                break
-            yield
-            button_image_batch = self.process_batch(self.n_images_per_cycle - self.last_button_column)
-        self.show_more_button["state"] = DISABLED
-        yield
+    def show_more(self):
+        """
+        requests enough images to fill the next page. Doesn't wait for the previous page to be fetched
+        """
+        n_reserved_slots = len(self.slots) - len(self.free_slots)
+        step = self.n_images_per_cycle - n_reserved_slots % self.n_images_in_row
+        if self.prefetch_depth:
+            step -= self.take_prefetched(step)
+        self.process_batch(step)
+        self.prefetch()
+        self.update_show_more_state()
 
     def drop(self, event):
         if event.data:
-            data_path = event.data
-            button_img_batch = []
-            if os.path.exists(data_path):
-                img = Image.open(data_path)
-                button_img_batch.append(ImageTk.PhotoImage(
-                    self.prepare_image(img, width=self.optimal_visual_width, height=self.optimal_visual_height)))
-                self.saving_images.append(img)
-                self.saving_images_names.append(hash(random.random()))
-            elif data_path.startswith("http"):
-                self.img_urls.appendleft(data_path)
-                button_img_batch.extend(self.process_batch(step=1,
-                                                           request_depth=self.max_request_tries))
-            self.show_button_image_batch(button_img_batch)
+            paths, urls = self.parse_drop(event.data)
+            self.import_dropped(paths, urls)
         return event.action
 
+    def parse_drop(self, data):
+        """
+        splits dropped data into local files and urls. Data is either Tk list of paths (paths with spaces are
+        braced) or text with urls separated by newlines. Directories are walked recursively for images
+        :return: paths, urls
+        """
+        if os.path.exists(data):  # single path with spaces that isn't braced
+            items = [data]
+        else:
+            try:
+                items = self.tk.splitlist(data)
+            except TclError:  # text that isn't a valid Tk list
+                items = data.split()
+
+        paths = []
+        urls = []
+        for item in items:
+            item = item.strip()
+            if item.startswith("file:"):
+                from urllib.request import url2pathname
+                item = url2pathname(urlsplit(item).path)
+            if os.path.isdir(item):
+                paths.extend(self.walk_images(item))
+            elif os.path.isfile(item):
+                paths.append(item)
+            elif urlsplit(item).scheme in ("http", "https"):
+                urls.append(item)
+        return paths, urls
+
+    @staticmethod
+    def walk_images(directory) -> list:
+        """
+        :return: sorted paths of images in the directory and in its subdirectories
+        """
+        extensions = Image.registered_extensions()
+        paths = []
+        for root, dirnames, filenames in os.walk(directory):
+            dirnames.sort()
+            paths.extend(os.path.join(root, filename) for filename in sorted(filenames)
+                         if os.path.splitext(filename)[1].lower() in extensions)
+        return paths
+
+    def import_dropped(self, paths, urls):
+        """
+        reads and decodes dropped files and fetches dropped urls in parallel on the fetch backend.
+        Every item gets its cell at once, progress is shown until all of them are done
+        """
+        paths = [path for path in dict.fromkeys(map(os.path.abspath, paths)) if path not in self.dropped_paths]
+        self.dropped_paths.update(paths)
+        urls = [url for url in urls if self.img_urls.add_seen(url)]
+        for items, local in ((paths, True), (urls, False)):
+            if not items:
+                continue
+            batch = FetchBatch(token=self.cancel_token, local=local)
+            for item in items:
+                self.url_slots[item] = self.reserve_slot()
+                self.submit_fetch(item, batch)
+            self.active_batches[batch] = None
+            self.drop_batches.add(batch)
+            self.n_dropped += len(items)
+        if self.drop_batches:
+            self.update_drop_progress()
+            self.schedule_polling()
+
+    def update_drop_progress(self):
+        if not self.drop_batches:
+            self.n_dropped = self.n_dropped_done = 0
+            self.drop_progress.grid_remove()
+            return
+        self.drop_progress.configure(maximum=self.n_dropped, value=self.n_dropped_done)
+        self.drop_progress.grid(row=2, column=0, columnspan=2, sticky="news")
+
+
+class _BatchItem:
+    """
+    state of one line of batch input
+    """
+    def __init__(self, item, is_url, target, processed):
+        """
+        :param processed: {url: status name} of urls processed by previous runs
+        """
+        self.item = item
+        self.is_url = is_url
+        self.target = target
+        self.processed = processed
+        self.frontier = URLFrontier([] if item in processed else [item]) if is_url else None
+        self.scraping = False
+        self.done = False
+        self.n_saved = sum(status == ImageFetcher.StatusCodes.NORMAL.name for status in processed.values())
+        self.n_in_flight = 0
+        self.n_retrying = 0
+
+    @property
+    def ready(self):
+        return self.frontier is not None and bool(self.frontier) and self.n_saved + self.n_in_flight < self.target
+
+    @property
+    def finished(self):
+        return self.frontier is not None and self.n_in_flight == 0 and \
+            (self.n_saved >= self.target or not self.frontier and not self.n_retrying)
+
+
+class BatchImageSearch(ImageFetcher):
+    """
+    Headless bulk downloader. Every input item is either an image url, that is saved as is,
+    or a query, whose image urls are given by url_scrapper. Results are written to a JSONL manifest,
+    so that interrupted run can be resumed
+    """
+    MANIFEST_NAME = "manifest.jsonl"
+
+    def __init__(self, saving_dir, **kwargs):
+        """
+        saving_dir: directory images are saved to. Images of a query are saved to its own subdirectory\n
+        url_scrapper: function that returns image urls of a query: list, generator, async iterator or paged
+            callback (see URLSource)\n
+        query_cache: QueryCache that keeps url lists of queries between runs (see CachedURLScrapper)\n
+        images_per_query: how many images are saved for every query\n
+        max_workers: how many urls (and queries being scrapped) are processed simultaneously\n
+        max_request_tries: how many times to request an url before giving up. Retries are delayed with
+            jittered exponential backoff, urls of hosts with tripped circuit breakers are deferred\n
+        manifest_path: JSONL manifest. saving_dir/manifest.jsonl by default\n
+        on_item_done: called with item and number of saved images when item is finished\n
+        other parameters are the same as ImageSearch ones: headers, http_client, max_connections,
+        max_connections_per_host, http_retries, image_cache, timeout, max_download_size, max_image_pixels,
+        saving_image_width, saving_image_height, saving_image_format, saving_image_quality,
+        image_saving_name_pattern, metrics
+        """
+        kwargs.setdefault("max_retries", max(1, kwargs.get("max_request_tries", 3)) - 1)
+        super(BatchImageSearch, self).__init__(**kwargs)
+        self.saving_dir = saving_dir
+        self.url_scrapper = kwargs.get("url_scrapper")
+        query_cache = kwargs.get("query_cache")
+        if query_cache is not None and self.url_scrapper is not None and \
+                not isinstance(self.url_scrapper, CachedURLScrapper):
+            self.url_scrapper = CachedURLScrapper(self.url_scrapper, query_cache)
+        self.images_per_query = kwargs.get("images_per_query", 10)
+        self.max_workers = max(1, kwargs.get("max_workers", 16))
+        self.cancel_token = CancellationToken()
+        self.manifest_path = kwargs.get("manifest_path", os.path.join(saving_dir, self.MANIFEST_NAME))
+        self.on_item_done = kwargs.get("on_item_done")
+
+    @staticmethod
+    def is_url(item) -> bool:
+        return urlsplit(item).scheme in ("http", "https")
+
+    @staticmethod
+    def query_dirname(query) -> str:
+        return re.sub(r"[^\w\-]+", "_", query).strip("_")[:100] or "_"
+
+    def read_manifest(self):
+        """
+        :return: finished items, {item: {url: status name}} of already processed urls
+        """
+        done = set()
+        processed = {}
+        if not os.path.exists(self.manifest_path):
+            return done, processed
+        with open(self.manifest_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:  # line torn by a crash
+                    continue
+                if record.get("done"):
+                    done.add(record["item"])
+                elif "url" in record:
+                    processed.setdefault(record["item"], {})[record["url"]] = record["status"]
+        return done, processed
+
+    def run(self, items) -> dict:
+        """
+        processes items skipping ones finished by previous runs with the same manifest
+        :param items: iterable of queries and image urls
+        :return: summary
+        """
+        done, processed = self.read_manifest()
+        pending = deque()
+        summary = {"items": 0, "skipped": 0, "saved": 0, "failed": 0}
+        for item in items:
+            summary["items"] += 1
+            if item in done:
+                summary["skipped"] += 1
+                continue
+            is_url = self.is_url(item)
+            if not is_url and self.url_scrapper is None:
+                raise ValueError(f"url_scrapper is required to process query {item!r}")
+            pending.append(_BatchItem(item, is_url, 1 if is_url else self.images_per_query, processed.get(item, {})))
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.manifest_path)), exist_ok=True)
+        running = {}
+        with open(self.manifest_path, "a", encoding="utf-8") as manifest, \
+                ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            if manifest.tell():  # finish line torn by a crash
+                with open(self.manifest_path, "rb") as f:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b"\n":
+                        manifest.write("\n")
+
+            def record(data):
+                manifest.write(json.dumps(data, ensure_ascii=False) + "\n")
+                manifest.flush()
+
+            def finish(state):
+                pending.remove(state)
+                state.done = True
+                record({"item": state.item, "done": True, "n_saved": state.n_saved})
+                if self.on_item_done is not None:
+                    self.on_item_done(state.item, state.n_saved)
+
+            def record_result(state, url, status, path=None):
+                if status == ImageFetcher.StatusCodes.NORMAL:
+                    state.n_saved += 1
+                    summary["saved"] += 1
+                else:
+                    summary["failed"] += 1
+                if self.metrics is not None:
+                    self.metrics.finish(url, status)
+                record({"item": state.item, "url": url, "status": status.name, "path": path})
+
+            try:
+                while pending or running:
+                    for url, state in self.retry_scheduler.pop_ready():
+                        state.n_retrying -= 1
+                        if not state.done:
+                            state.frontier.requeue(url, left=True)
+                    if self.cancel_token.cancelled:  # wait for aborted downloads only
+                        wait(running)
+                        break
+                    for state in [state for state in pending if state.finished]:
+                        finish(state)
+                    # round robin over items, so that every item gets its share of workers
+                    while len(running) < self.max_workers:
+                        state = next((state for state in pending
+                                      if state.ready or state.frontier is None and not state.scraping), None)
+                        if state is None:
+                            break
+                        pending.rotate(-(pending.index(state) + 1))
+                        if state.frontier is None:
+                            state.scraping = True
+                            running[pool.submit(self.scrape, state.item)] = (state, None)
+                        else:
+                            url = state.frontier.popleft()[0]
+                            if self.host_health.is_dead(url):
+                                record_result(state, url, ImageFetcher.StatusCodes.HOST_UNAVAILABLE)
+                            elif not self.host_health.acquire(url):
+                                state.n_retrying += 1
+                                self.retry_scheduler.defer(url, state)
+                            else:
+                                state.n_in_flight += 1
+                                running[pool.submit(self.fetch_and_save, url, state)] = (state, url)
+                    if not running:
+                        if self.retry_scheduler:
+                            time.sleep(self.retry_scheduler.next_delay())
+                        continue
+
+                    finished, _ = wait(running, timeout=self.retry_scheduler.next_delay(), return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        state, url = running.pop(future)
+                        if url is None:
+                            state.scraping = False
+                            try:
+                                urls = future.result()
+                            except Exception as e:
+                                record({"item": state.item, "status": "SCRAPPING_ERROR", "error": repr(e)})
+                                pending.remove(state)
+                                summary["failed"] += 1
+                                continue
+                            state.frontier = URLFrontier(url for url in urls if url not in state.processed)
+                            continue
+
+                        state.n_in_flight -= 1
+                        status, path = future.result()
+                        if status == ImageFetcher.StatusCodes.CANCELLED:
+                            continue
+                        if status == ImageFetcher.StatusCodes.RETRIABLE_FETCHING_ERROR and \
+                                self.retry_scheduler.schedule(url, state):
+                            state.n_retrying += 1
+                            continue
+                        record_result(state, url, status, path)
+            except BaseException:  # e.g. KeyboardInterrupt: don't wait for downloads that are in flight
+                self.cancel_token.cancel()
+                raise
+        return summary
+
+    def scrape(self, query) -> list:
+        """
+        :return: all urls of the query. url_scrapper may return anything URLSource accepts
+        """
+        return list(URLSource.iterate(self.url_scrapper(query)))
+
+    def fetch_and_save(self, url, state: _BatchItem):
+        """
+        worker part of the batch. Safe to call outside of the coordinating thread
+        :return: status, saving path or None
+        """
+        content, url = self.fetch(url, self.cancel_token)
+        if isinstance(content, ImageFetcher.StatusCodes):
+            return content, None
+        saving_dir = self.saving_dir if state.is_url else os.path.join(self.saving_dir,
+                                                                       self.query_dirname(state.item))
+        start = time.perf_counter()
+        try:
+            saving_path = self.write_image(content, os.path.join(saving_dir, self.saving_name(url)))
+        except (IOError, UnicodeError, ValueError, Image.DecompressionBombError):
+            return ImageFetcher.StatusCodes.IMAGE_PROCESSING_ERROR, None
+        if self.metrics is not None:
+            self.metrics.update(url, save=time.perf_counter() - start)
+        return ImageFetcher.StatusCodes.NORMAL, saving_path
+
+    def cancel(self):
+        """
+        stops run from any thread: downloads in flight are aborted, unfinished items are left for the next run
+        """
+        self.cancel_token.cancel()
+
+    def close(self):
+        self.close_fetching()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
 
 if __name__ == "__main__":
     from tkinterdnd2 import Tk
@@ -0,0 +1,85 @@
+"""
+Downloads images for every line of the input file without opening any windows.
+Line is either an image url, that is saved as is, or a query, whose image urls are given by --scrapper.
+Finished lines are remembered in the manifest, so rerunning the same command resumes interrupted run.
+
+usage: python batch_search.py queries.txt --saving-dir images --scrapper my_module:get_image_links
+"""
+import argparse
+import importlib
+import sys
+
+from ImageSearch import BatchImageSearch, ImageCache
+
+
+def load_scrapper(path):
+    """
+    :param path: "module:function"
+    """
+    module_name, _, function_name = path.partition(":")
+    if not function_name:
+        raise argparse.ArgumentTypeError(f"expected module:function, got {path!r}")
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def read_items(path):
+    with (sys.stdin if path == "-" else open(path, encoding="utf-8")) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                yield line
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="file with one query or image url per line, - for stdin")
+    parser.add_argument("--saving-dir", required=True)
+    parser.add_argument("--scrapper", type=load_scrapper, help="module:function that returns image urls of a query")
+    parser.add_argument("--manifest", help="JSONL manifest. SAVING_DIR/manifest.jsonl by default")
+    parser.add_argument("--images-per-query", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--tries", type=int, default=3)
+    parser.add_argument("--timeout", type=float, default=5)
+    parser.add_argument("--saving-width", type=int)
+    parser.add_argument("--saving-height", type=int)
+    parser.add_argument("--format", default="png")
+    parser.add_argument("--quality", type=int, default=90)
+    parser.add_argument("--name-pattern", default="{}")
+    parser.add_argument("--cache-dir", help="keep fetched images in an ImageCache")
+    parser.add_argument("--metrics", help="export per-url stage timings to this json or csv file")
+    args = parser.parse_args()
+
+    kwargs = {}
+    if args.manifest is not None:
+        kwargs["manifest_path"] = args.manifest
+    if args.cache_dir is not None:
+        kwargs["image_cache"] = ImageCache(args.cache_dir)
+    if args.metrics is not None:
+        kwargs["metrics"] = True
+
+    with BatchImageSearch(args.saving_dir,
+                          url_scrapper=args.scrapper,
+                          images_per_query=args.images_per_query,
+                          max_workers=args.workers,
+                          max_request_tries=args.tries,
+                          max_connections=args.workers,
+                          timeout=args.timeout,
+                          saving_image_width=args.saving_width,
+                          saving_image_height=args.saving_height,
+                          saving_image_format=args.format,
+                          saving_image_quality=args.quality,
+                          image_saving_name_pattern=args.name_pattern,
+                          on_item_done=lambda item, n_saved: print(f"{n_saved:>4} {item}", flush=True),
+                          **kwargs) as batch:
+        summary = batch.run(read_items(args.input))
+        if batch.metrics is not None:
+            batch.metrics.export(args.metrics)
+        unhealthy_hosts = {host: health for host, health in batch.host_health.report().items()
+                           if health["state"] != "closed"}
+    print("items: {items}, skipped: {skipped}, saved: {saved}, failed: {failed}".format(**summary))
+    for host, health in unhealthy_hosts.items():
+        print(f"{host}: {health['state']}, {health['failures']} failures, {health['successes']} successes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Measures how decoding of fetched images into display thumbnails scales with the number of cores:
+fetch-worker threads decoding in process (ImageFetcher.process_fetched_data) against DecodeProcessPool.
+
+For every number of --workers, the same corpus of generated images is decoded by that many threads and by
+a pool of that many processes (fed by that many threads). Throughput in images per second and speedup over
+one worker are printed. Spawning of the worker processes is measured separately and isn't part of throughput.
+
+usage: python benchmarks/bench_decode_processes.py [--workers 1,2,4,8] [--images 200] [--size 1920x1080] [--json]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ImageSearch import ImageFetcher, DecodeProcessPool
+from image_server import generate_image, N_VARIANTS
+
+
+def make_corpus(n_images, size, image_format) -> list:
+    variants = []
+    for variant in range(N_VARIANTS):
+        buffer = BytesIO()
+        generate_image(size, variant).save(buffer, format=image_format, quality=90)
+        variants.append(buffer.getvalue())
+    return [variants[i % N_VARIANTS] for i in range(n_images)]
+
+
+def throughput(decode, contents, n_workers) -> float:
+    """
+    :return: images per second decoded by n_workers threads
+    """
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        start = time.perf_counter()
+        statuses = list(pool.map(decode, contents))
+        elapsed = time.perf_counter() - start
+    if any(status != ImageFetcher.StatusCodes.NORMAL for status in statuses):
+        raise RuntimeError("some images weren't decoded")
+    return len(contents) / elapsed
+
+
+def bench(contents, n_workers, width, height):
+    fetcher = ImageFetcher(show_image_width=width, show_image_height=height)
+    threads = throughput(lambda content: fetcher.process_fetched_data(content)[0], contents, n_workers)
+
+    start = time.perf_counter()
+    decode_pool = DecodeProcessPool(max_workers=n_workers)
+    # every worker process is started and imports its modules before the measurement
+    throughput(lambda content: decode_pool.decode(content, width, height)[0], contents[:n_workers * 2], n_workers)
+    startup = time.perf_counter() - start
+    try:
+        processes = throughput(lambda content: decode_pool.decode(content, width, height)[0], contents, n_workers)
+    finally:
+        decode_pool.shutdown()
+    return {"workers": n_workers,
+            "threads_per_s": round(threads, 1),
+            "processes_per_s": round(processes, 1),
+            "process_startup_ms": round(startup * 1000, 1)}
+
+
+def parse_size(size):
+    width, _, height = size.partition("x")
+    return int(width), int(height)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    n_cores = os.cpu_count() or 1
+    default_workers = [n for n in (1, 2, 4, 8, 16, 32) if n < n_cores] + [n_cores]
+    parser.add_argument("--workers", default=",".join(map(str, default_workers)),
+                        type=lambda value: [int(n) for n in value.split(",")])
+    parser.add_argument("--images", type=int, default=200)
+    parser.add_argument("--size", type=parse_size, default=(1920, 1080), help="size of the decoded images")
+    parser.add_argument("--format", default="JPEG")
+    parser.add_argument("--width", type=int, default=300, help="maximum thumbnail width")
+    parser.add_argument("--height", type=int, default=300, help="maximum thumbnail height")
+    parser.add_argument("--json", action="store_true", help="print results as json")
+    args = parser.parse_args()
+
+    contents = make_corpus(args.images, args.size, args.format.upper())
+    results = [bench(contents, n_workers, args.width, args.height) for n_workers in args.workers]
+    for result in results:
+        result["threads_speedup"] = round(result["threads_per_s"] / results[0]["threads_per_s"], 2)
+        result["processes_speedup"] = round(result["processes_per_s"] / results[0]["processes_per_s"], 2)
+
+    if args.json:
+        print(json.dumps({"cpu_count": os.cpu_count(), "results": results}, indent=2))
+        return
+
+    print(f"{args.images} {args.format.upper()} images {args.size[0]}x{args.size[1]}, {os.cpu_count()} cores")
+    print(f"{'workers':>7}{'threads':>14}{'speedup':>9}{'processes':>14}{'speedup':>9}{'startup':>12}")
+    for result in results:
+        print(f"{result['workers']:>7}{result['threads_per_s']:>10.1f} i/s{result['threads_speedup']:>8.2f}x"
+              f"{result['processes_per_s']:>10.1f} i/s{result['processes_speedup']:>8.2f}x"
+              f"{result['process_startup_ms']:>9.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,357 @@
+"""
+Benchmarks fetching, decoding, resizing and saving against the local image server (benchmarks/image_server.py).
+
+scenarios:
+    fetch   - ImageFetcher.fetch with --concurrency simultaneous requests
+    decode  - Image.open and display thumbnail of fetched images (process_fetched_data)
+    prepare - prepare_image to saving size
+    save    - write_image of fetched images to a temporary directory
+    batch   - headless BatchImageSearch run over all urls
+    gui     - ImageSearch window: process_batch of every page until it is shown, then close_image_search.
+              Needs a display, --virtual-display starts Xvfb through pyvirtualdisplay
+
+Faults are injected into a --error-rate, --timeout-rate and --slow-rate share of urls.
+Results are printed as json, --compare prints the change against results of another commit.
+
+usage: python benchmarks/bench_pipeline.py [--images 200] [--output results.json] [--compare baseline.json]
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import PIL
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ImageSearch import ImageFetcher, BatchImageSearch
+from image_server import ImageServer
+
+
+SCENARIOS = ("fetch", "decode", "prepare", "save", "batch", "gui")
+
+
+class PeakMemory:
+    """
+    peak of resident set size (sampled, linux only) inside the with block.
+    Peak of python allocations is traced too when trace is set: tracing slows everything down severalfold
+    """
+    SAMPLING_INTERVAL = 0.005
+    trace = False
+
+    def __init__(self):
+        self.peak_rss = None
+        self.peak_traced = None
+        self._baseline_rss = None
+        self._stop = threading.Event()
+        self._sampler = None
+
+    @staticmethod
+    def rss():
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, AttributeError):
+            return None
+
+    def _sample(self):
+        while not self._stop.wait(self.SAMPLING_INTERVAL):
+            self.peak_rss = max(self.peak_rss, self.rss())
+
+    def __enter__(self):
+        if self.trace:
+            tracemalloc.start()
+        self._baseline_rss = self.peak_rss = self.rss()
+        if self._baseline_rss is not None:
+            self._sampler = threading.Thread(target=self._sample, daemon=True)
+            self._sampler.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.trace:
+            self.peak_traced = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+
+    def report(self) -> dict:
+        mb = 2 ** 20
+        return {"peak_traced_mb": round(self.peak_traced / mb, 2) if self.peak_traced is not None else None,
+                "peak_rss_mb": round(self.peak_rss / mb, 2) if self.peak_rss is not None else None,
+                "peak_rss_growth_mb": round((self.peak_rss - self._baseline_rss) / mb, 2)
+                if self.peak_rss is not None else None}
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(q / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(name, latencies, wall_time, statuses, n_bytes, memory: PeakMemory) -> dict:
+    latencies = sorted(latencies)
+    result = {"scenario": name,
+              "n": len(statuses),
+              "statuses": {status: statuses.count(status) for status in sorted(set(statuses))},
+              "wall_s": round(wall_time, 4),
+              "throughput_per_s": round(len(statuses) / wall_time, 2) if wall_time else None,
+              "mb_per_s": round(n_bytes / 2 ** 20 / wall_time, 2) if wall_time else None,
+              "latency_ms": {"p50": percentile(latencies, 50), "p95": percentile(latencies, 95),
+                             "p99": percentile(latencies, 99),
+                             "mean": sum(latencies) / len(latencies) if latencies else None,
+                             "max": latencies[-1] if latencies else None}}
+    result["latency_ms"] = {key: round(value * 1000, 3) if value is not None else None
+                            for key, value in result["latency_ms"].items()}
+    result.update(memory.report())
+    return result
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def make_urls(server, args):
+    rng = random.Random(args.seed)
+    urls = []
+    for image_id in range(args.images):
+        faults = {"latency": max(0, round(rng.gauss(args.latency, args.jitter)))}
+        roll = rng.random()
+        if roll < args.error_rate:
+            faults["status"] = rng.choice((403, 404, 500, 503))
+        elif roll < args.error_rate + args.timeout_rate:
+            faults["hang"] = args.timeout * 3
+        elif roll < args.error_rate + args.timeout_rate + args.slow_rate:
+            faults["slow"] = args.slow_bps
+        urls.append(server.url(image_id, rng.choice(args.formats), rng.choice(args.sizes), **faults))
+    return urls
+
+
+def bench_fetch(fetcher, urls, args):
+    contents = {}
+    latencies = []
+    statuses = []
+
+    def fetch(url):
+        return timed(fetcher.fetch, url)
+
+    with PeakMemory() as memory, ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        start = time.perf_counter()
+        for latency, (content, url) in pool.map(fetch, urls):
+            latencies.append(latency)
+            if isinstance(content, ImageFetcher.StatusCodes):
+                statuses.append(content.name)
+            else:
+                statuses.append(ImageFetcher.StatusCodes.NORMAL.name)
+                contents[url] = content
+        wall_time = time.perf_counter() - start
+    return summarize("fetch", latencies, wall_time, statuses, sum(map(len, contents.values())), memory), contents
+
+
+def bench_each(name, func, contents):
+    latencies = []
+    statuses = []
+    with PeakMemory() as memory:
+        start = time.perf_counter()
+        for content in contents:
+            latency, status = timed(func, content)
+            latencies.append(latency)
+            statuses.append(status.name)
+        wall_time = time.perf_counter() - start
+    return summarize(name, latencies, wall_time, statuses, sum(map(len, contents)), memory)
+
+
+def bench_batch(urls, args, saving_dir):
+    latencies = []
+    with PeakMemory() as memory:
+        start = time.perf_counter()
+        with BatchImageSearch(os.path.join(saving_dir, "batch"), max_workers=args.concurrency,
+                              max_connections=args.concurrency, timeout=args.timeout,
+                              saving_image_width=args.saving_width, saving_image_height=args.saving_height,
+                              on_item_done=lambda item, n_saved: latencies.append(time.perf_counter() - start)) \
+                as batch:
+            summary = batch.run(urls)
+        wall_time = time.perf_counter() - start
+    statuses = ["NORMAL"] * summary["saved"] + ["FAILED"] * summary["failed"]
+    # items finish in arbitrary order, so per-item latency is time since the start of the run
+    return summarize("batch", latencies, wall_time, statuses, 0, memory)
+
+
+def bench_gui(urls, args, saving_dir):
+    from tkinterdnd2 import Tk
+    from ImageSearch import ImageSearch
+
+    display = None
+    if args.virtual_display:
+        from pyvirtualdisplay import Display
+        display = Display(visible=False, size=(1920, 1080))
+        display.start()
+    try:
+        root = Tk()
+        root.withdraw()
+        closed = []
+        with PeakMemory() as memory:
+            search = ImageSearch(search_term="benchmark", master=root, saving_dir=saving_dir, init_urls=urls,
+                                 timeout=args.timeout, show_image_width=300, show_image_height=300,
+                                 saving_image_width=args.saving_width, saving_image_height=args.saving_height,
+                                 on_close_action=lambda window: closed.append(time.perf_counter()))
+            start = time.perf_counter()
+            page_latencies = []
+            search.start()
+            while True:
+                page_start = time.perf_counter()
+                while search.active_batches:
+                    root.update()
+                    time.sleep(0.001)
+                page_latencies.append(time.perf_counter() - page_start)
+                if not search.img_urls:
+                    break
+                search.show_more()
+
+            search.saving_indices = list(range(len(search.saving_images_names)))
+            n_shown = len(search.saving_indices)
+            saving_start = time.perf_counter()
+            search.close_image_search()
+            while not closed:
+                root.update()
+                time.sleep(0.001)
+            wall_time = time.perf_counter() - start
+        results = [summarize("gui_pages", page_latencies, saving_start - start,
+                             ["NORMAL"] * n_shown, 0, memory)]
+        results[0]["statuses"] = {"NORMAL": n_shown, "FAILED": len(urls) - n_shown}
+        results.append({"scenario": "gui_close_image_search", "n": n_shown,
+                        "wall_s": round(closed[0] - saving_start, 4), "total_wall_s": round(wall_time, 4)})
+        root.destroy()
+        return results
+    finally:
+        if display is not None:
+            display.stop()
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {result["scenario"]: result for result in json.load(f)["results"]}
+    print(f"{'scenario':<24}{'metric':<18}{'baseline':>12}{'current':>12}{'change':>9}")
+    for result in results:
+        old = baseline.get(result["scenario"])
+        if old is None:
+            continue
+        metrics = [("throughput_per_s", result.get("throughput_per_s"), old.get("throughput_per_s")),
+                   ("wall_s", result.get("wall_s"), old.get("wall_s")),
+                   ("peak_rss_growth_mb", result.get("peak_rss_growth_mb"), old.get("peak_rss_growth_mb"))]
+        metrics += [(f"latency_{key}_ms", value, old.get("latency_ms", {}).get(key))
+                    for key, value in result.get("latency_ms", {}).items() if key in ("p50", "p95", "p99")]
+        for metric, new_value, old_value in metrics:
+            if new_value is None or old_value is None:
+                continue
+            change = f"{(new_value - old_value) / old_value * 100:+.1f}%" if old_value else ""
+            print(f"{result['scenario']:<24}{metric:<18}{old_value:>12}{new_value:>12}{change:>9}")
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_size(size):
+    width, _, height = size.partition("x")
+    return int(width), int(height)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default="fetch,decode,prepare,save,batch",
+                        help=f"comma separated subset of {','.join(SCENARIOS)}")
+    parser.add_argument("--images", type=int, default=200)
+    parser.add_argument("--formats", default="jpeg,png,webp", type=lambda value: value.split(","))
+    parser.add_argument("--sizes", default="640x480,1920x1080",
+                        type=lambda value: [parse_size(size) for size in value.split(",")])
+    parser.add_argument("--latency", type=float, default=20, help="mean server latency, ms")
+    parser.add_argument("--jitter", type=float, default=10, help="standard deviation of server latency, ms")
+    parser.add_argument("--error-rate", type=float, default=0.05, help="share of 4xx/5xx responses")
+    parser.add_argument("--timeout-rate", type=float, default=0.02, help="share of requests that time out")
+    parser.add_argument("--slow-rate", type=float, default=0.05, help="share of slowly sent bodies")
+    parser.add_argument("--slow-bps", type=int, default=2 ** 20, help="rate of slow bodies, bytes per second")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--timeout", type=float, default=1)
+    parser.add_argument("--saving-width", type=int, default=1024)
+    parser.add_argument("--saving-height", type=int, default=1024)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--trace-malloc", action="store_true", help="report peak of python allocations")
+    parser.add_argument("--virtual-display", action="store_true", help="run gui scenario on Xvfb")
+    parser.add_argument("--output", help="write json results to this file")
+    parser.add_argument("--compare", help="json results to compare with")
+    args = parser.parse_args()
+    scenarios = args.scenarios.split(",")
+    PeakMemory.trace = args.trace_malloc
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    results = []
+    with ImageServer() as server, tempfile.TemporaryDirectory() as saving_dir:
+        server.prepare(args.formats, args.sizes)
+        urls = make_urls(server, args)
+        fetcher = ImageFetcher(max_connections=args.concurrency, max_connections_per_host=args.concurrency,
+                               timeout=args.timeout, show_image_width=300, show_image_height=300,
+                               saving_image_width=args.saving_width, saving_image_height=args.saving_height)
+        fetch_result, contents = bench_fetch(fetcher, urls, args)
+        if "fetch" in scenarios:
+            results.append(fetch_result)
+        fetched = list(contents.values())
+        if "decode" in scenarios:
+            results.append(bench_each("decode", lambda content: fetcher.process_fetched_data(content)[0], fetched))
+        if "prepare" in scenarios:
+            def prepare(content):
+                fetcher.prepare_image(Image.open(BytesIO(content)), width=args.saving_width,
+                                      height=args.saving_height).load()
+                return ImageFetcher.StatusCodes.NORMAL
+            results.append(bench_each("prepare", prepare, fetched))
+        if "save" in scenarios:
+            names = iter(range(len(fetched)))
+
+            def save(content):
+                fetcher.write_image(content, os.path.join(saving_dir, "save", str(next(names))))
+                return ImageFetcher.StatusCodes.NORMAL
+            results.append(bench_each("save", save, fetched))
+        fetcher.close_fetching()
+        if "batch" in scenarios:
+            results.append(bench_batch(urls, args, saving_dir))
+        if "gui" in scenarios:
+            results.extend(bench_gui(urls, args, os.path.join(saving_dir, "gui")))
+        server_stats = dict(server.stats)
+
+    report = {"meta": {"commit": git_commit(),
+                       "python": platform.python_version(),
+                       "pillow": PIL.__version__,
+                       "platform": platform.platform(),
+                       "cpu_count": os.cpu_count(),
+                       "args": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+                       "server": server_stats},
+              "results": results}
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare is not None:
+        compare(results, args.compare)
+    elif args.output is None:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
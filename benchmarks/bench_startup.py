@@ -0,0 +1,139 @@
+"""
+Measures how fast ImageSearch starts. Every run is a fresh interpreter, so imports are measured cold.
+
+measurements:
+    import      - import of ImageSearch and the heavy modules (requests, PIL, asyncio) it loaded eagerly
+    window      - from the start of the interpreter to the first paint of the window (<Expose>),
+                  to the first started fetch and to the first shown image of the local image server.
+                  Needs a display, --virtual-display starts Xvfb through pyvirtualdisplay
+
+Medians of --repeat runs are printed. Exits with 1 if the median time to the first paint exceeds --max-first-paint-ms
+
+usage: python benchmarks/bench_startup.py [--repeat 5] [--virtual-display] [--json] [--max-first-paint-ms 500]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+HEAVY_MODULES = ("requests", "urllib3", "PIL.Image", "PIL.ImageTk", "asyncio")
+
+
+def run_import():
+    start = time.perf_counter()
+    import ImageSearch  # noqa: F401
+    return {"import_s": time.perf_counter() - start,
+            "eager_modules": [module for module in HEAVY_MODULES if module in sys.modules]}
+
+
+def run_window(urls, timeout):
+    start = time.perf_counter()
+    marks = {}
+
+    def mark(name):
+        marks.setdefault(name, time.perf_counter() - start)
+
+    from tkinterdnd2 import Tk
+    from ImageSearch import ImageSearch
+    mark("import")
+    root = Tk()
+    root.withdraw()
+    with tempfile.TemporaryDirectory() as saving_dir:
+        search = ImageSearch(search_term="startup", master=root, saving_dir=saving_dir, init_urls=urls,
+                             show_image_width=200, show_image_height=200, metrics=True)
+        search.bind("<Expose>", lambda event: mark("first_paint"), add="+")
+        search.start()
+        mark("started")
+        deadline = time.perf_counter() + timeout
+        while "first_image" not in marks and time.perf_counter() < deadline:
+            root.update()
+            if search.metrics.records():
+                mark("first_fetch")
+            if search.n_shown:
+                mark("first_image")
+            time.sleep(0.0005)
+        search.destroy()
+    root.destroy()
+    return {f"{name}_s": value for name, value in marks.items()}
+
+
+def run_child(mode, urls=(), timeout=10):
+    """
+    :return: measurements of one run in a fresh interpreter
+    """
+    command = [sys.executable, os.path.abspath(__file__), "--child", mode, "--timeout", str(timeout)] + list(urls)
+    process = subprocess.run(command, capture_output=True, text=True, cwd=ROOT)
+    if process.returncode:
+        raise RuntimeError(f"{mode} run failed:\n{process.stderr}")
+    return json.loads(process.stdout.splitlines()[-1])
+
+
+def summarize(runs):
+    summary = {}
+    for key in runs[0]:
+        values = [run[key] for run in runs if key in run]
+        if key.endswith("_s"):
+            summary[key[:-2] + "_ms"] = round(statistics.median(values) * 1000, 2)
+        else:
+            summary[key] = values[0]
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--images", type=int, default=15, help="images of the first page")
+    parser.add_argument("--timeout", type=float, default=10, help="seconds to wait for the first image")
+    parser.add_argument("--virtual-display", action="store_true", help="run window measurement on Xvfb")
+    parser.add_argument("--no-window", action="store_true", help="measure import only")
+    parser.add_argument("--max-first-paint-ms", type=float, help="fail if the first paint takes longer")
+    parser.add_argument("--json", action="store_true", help="print results as json")
+    parser.add_argument("--child", choices=("import", "window"), help=argparse.SUPPRESS)
+    parser.add_argument("urls", nargs="*", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child == "import":
+        print(json.dumps(run_import()))
+        return
+    if args.child == "window":
+        print(json.dumps(run_window(args.urls, args.timeout)))
+        return
+
+    results = {"import": summarize([run_child("import") for _ in range(args.repeat)])}
+    if not args.no_window:
+        from image_server import ImageServer
+        display = None
+        if args.virtual_display:
+            from pyvirtualdisplay import Display
+            display = Display(visible=False, size=(1920, 1080))
+            display.start()
+        try:
+            with ImageServer() as server:
+                server.prepare(["jpeg"], [(1280, 960)])
+                urls = [server.url(image_id, "jpeg", (1280, 960), latency=20) for image_id in range(args.images)]
+                results["window"] = summarize([run_child("window", urls, args.timeout) for _ in range(args.repeat)])
+        finally:
+            if display is not None:
+                display.stop()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for name, summary in results.items():
+            print(f"{name}: " + "  ".join(f"{key} {value}" for key, value in summary.items()))
+
+    first_paint_ms = results.get("window", {}).get("first_paint_ms")
+    if args.max_first_paint_ms is not None and first_paint_ms is not None and \
+            first_paint_ms > args.max_first_paint_ms:
+        print(f"first paint took {first_paint_ms} ms, limit is {args.max_first_paint_ms} ms", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
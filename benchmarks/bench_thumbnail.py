@@ -0,0 +1,82 @@
+"""
+Compares ImageSearch.prepare_image with ImageSearch.make_thumbnail on a corpus of generated images.
+
+usage: python benchmarks/bench_thumbnail.py [--width 300] [--height 300] [--repeat 5] [--json]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from io import BytesIO
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ImageSearch import ImageSearch
+from image_server import generate_image
+
+
+CORPUS = [
+    # format, save params, size
+    ("JPEG", {"quality": 90}, (640, 480)),
+    ("JPEG", {"quality": 90}, (1920, 1080)),
+    ("JPEG", {"quality": 90, "progressive": True}, (1920, 1080)),
+    ("JPEG", {"quality": 90}, (4000, 3000)),
+    ("PNG", {}, (1920, 1080)),
+    ("PNG", {}, (4000, 3000)),
+    ("WEBP", {"quality": 80}, (1920, 1080)),
+    ("GIF", {}, (800, 600)),
+]
+
+
+def encode(img, image_format, params) -> bytes:
+    buffer = BytesIO()
+    if image_format == "GIF":
+        img = img.convert("P")
+    img.save(buffer, format=image_format, **params)
+    return buffer.getvalue()
+
+
+def measure(func, content, width, height, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(Image.open(BytesIO(content)), width=width, height=height)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--width", type=int, default=300)
+    parser.add_argument("--height", type=int, default=300)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", action="store_true", help="print results as json")
+    args = parser.parse_args()
+
+    results = []
+    for image_format, params, size in CORPUS:
+        content = encode(generate_image(size), image_format, params)
+        prepare_time = measure(lambda img, **kw: ImageSearch.prepare_image(img, **kw).load(),
+                               content, args.width, args.height, args.repeat)
+        thumbnail_time = measure(ImageSearch.make_thumbnail, content, args.width, args.height, args.repeat)
+        results.append({"format": image_format + (" progressive" if params.get("progressive") else ""),
+                        "size": "{}x{}".format(*size),
+                        "bytes": len(content),
+                        "prepare_image_ms": round(prepare_time * 1000, 2),
+                        "make_thumbnail_ms": round(thumbnail_time * 1000, 2),
+                        "speedup": round(prepare_time / thumbnail_time, 2)})
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'format':<18}{'size':>11}{'prepare_image':>16}{'make_thumbnail':>16}{'speedup':>9}")
+    for result in results:
+        print(f"{result['format']:<18}{result['size']:>11}{result['prepare_image_ms']:>13.2f} ms"
+              f"{result['make_thumbnail_ms']:>13.2f} ms{result['speedup']:>8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""
+Local stand-in for image hosts. Serves generated images and injects faults on request,
+so that benchmarks don't depend on the network.
+
+url: /img/<id>.<format>?size=WxH&latency=ms&status=code&slow=bytes_per_second&hang=seconds
+    latency: delay before the response headers
+    status: respond with this error code instead of the image
+    slow: send the body at this rate
+    hang: don't respond for this long (client timeouts)
+
+usage: python benchmarks/image_server.py [--port 8000]
+"""
+import argparse
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from urllib.parse import urlsplit, parse_qs
+
+from PIL import Image
+
+
+CONTENT_TYPES = {"jpeg": "image/jpeg", "png": "image/png", "webp": "image/webp", "gif": "image/gif",
+                 "bmp": "image/bmp"}
+# number of distinct images of the same format and size
+N_VARIANTS = 4
+
+
+def generate_image(size, variant=0) -> Image.Image:
+    """
+    noisy gradient, so that encoders can't shrink it to nothing
+    """
+    gradient = Image.linear_gradient("L").resize(size)
+    noise = Image.effect_noise(size, 40 + variant)
+    if variant % 2:
+        gradient = gradient.transpose(Image.FLIP_TOP_BOTTOM)
+    return Image.merge("RGB", (gradient, noise, gradient.transpose(Image.FLIP_LEFT_RIGHT)))
+
+
+class _ImageRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        name = url.path.rsplit("/", 1)[-1]
+        image_id, _, image_format = name.partition(".")
+        image_format = image_format.lower().replace("jpg", "jpeg")
+        if not url.path.startswith("/img/") or image_format not in CONTENT_TYPES:
+            self.send_error_response(404)
+            return
+
+        self.server.stats["requests"] += 1
+        if "hang" in params:
+            time.sleep(float(params["hang"]))
+            self.close_connection = True
+            return
+        if "latency" in params:
+            time.sleep(float(params["latency"]) / 1000)
+        if "status" in params:
+            self.send_error_response(int(params["status"]))
+            return
+
+        width, _, height = params.get("size", "640x480").partition("x")
+        content = self.server.get_image(image_format, (int(width), int(height)),
+                                        int(image_id) % N_VARIANTS if image_id.isdigit() else 0)
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPES[image_format])
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        try:
+            if "slow" not in params:
+                self.wfile.write(content)
+            else:
+                self.write_slowly(content, float(params["slow"]))
+        except (BrokenPipeError, ConnectionResetError):  # client gave up
+            self.close_connection = True
+            return
+        self.server.stats["bytes_sent"] += len(content)
+
+    def write_slowly(self, content, bytes_per_second):
+        chunk_size = 4096
+        for start in range(0, len(content), chunk_size):
+            self.wfile.write(content[start:start + chunk_size])
+            self.wfile.flush()
+            time.sleep(chunk_size / bytes_per_second)
+
+    def send_error_response(self, status):
+        self.server.stats["errors"] += 1
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+class ImageServer(ThreadingHTTPServer):
+    """
+    Image server running on a background thread. Can be used as a context manager
+    """
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0):
+        super(ImageServer, self).__init__((host, port), _ImageRequestHandler)
+        self._images = {}
+        self._images_lock = threading.Lock()
+        self._thread = None
+        self.stats = {"requests": 0, "errors": 0, "bytes_sent": 0}
+
+    @property
+    def base_url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def url(self, image_id, image_format="jpeg", size=(640, 480), **faults) -> str:
+        """
+        :param faults: latency, status, slow, hang. See module docstring
+        """
+        query = "&".join([f"size={size[0]}x{size[1]}"] +
+                         [f"{key}={value}" for key, value in faults.items() if value is not None])
+        return f"{self.base_url}/img/{image_id}.{image_format}?{query}"
+
+    def get_image(self, image_format, size, variant=0) -> bytes:
+        key = (image_format, size, variant)
+        with self._images_lock:
+            if key not in self._images:
+                img = generate_image(size, variant)
+                if image_format == "gif":
+                    img = img.convert("P")
+                buffer = BytesIO()
+                img.save(buffer, format=image_format.upper(), quality=90)
+                self._images[key] = buffer.getvalue()
+            return self._images[key]
+
+    def prepare(self, formats, sizes):
+        """
+        generates images in advance, so that the first requests aren't slowed down by encoding
+        """
+        for image_format in formats:
+            for size in sizes:
+                for variant in range(N_VARIANTS):
+                    self.get_image(image_format.lower().replace("jpg", "jpeg"), tuple(size), variant)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+    server = ImageServer(args.host, args.port)
+    print(f"serving on {server.base_url}, example: {server.url(1, 'jpeg', (1920, 1080), latency=50)}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import pytest
+
+from ImageSearch import AdaptiveConcurrency
+
+
+def run_window(controller, clock, latency=0.05, error_every=None, n_bytes=1000):
+    """
+    fills the limit, then completes a window of fetches
+    """
+    n = controller.limit
+    for _ in range(n):
+        assert controller.try_acquire()
+    assert not controller.try_acquire()
+    for i in range(n):
+        clock.advance(0.01)
+        controller.release(latency=latency, error=error_every is not None and i % error_every == 0, n_bytes=n_bytes)
+
+
+def test_limits_are_validated():
+    with pytest.raises(ValueError):
+        AdaptiveConcurrency(min_limit=0)
+    with pytest.raises(ValueError):
+        AdaptiveConcurrency(min_limit=8, max_limit=4)
+
+
+def test_saturated_windows_increase_limit_up_to_max(clock):
+    controller = AdaptiveConcurrency(initial_limit=8, max_limit=10, clock=clock)
+    for expected in (9, 10, 10, 10):
+        run_window(controller, clock)
+        assert controller.limit == expected
+    assert [reason for _, _, reason in controller.history] == ["increase", "increase"]
+
+
+def test_unsaturated_window_keeps_limit(clock):
+    controller = AdaptiveConcurrency(initial_limit=8, clock=clock)
+    for _ in range(8):  # one fetch at a time
+        assert controller.try_acquire()
+        controller.release(latency=0.05)
+    assert controller.limit == 8
+
+
+def test_errors_decrease_limit_down_to_min(clock):
+    controller = AdaptiveConcurrency(initial_limit=8, min_limit=2, clock=clock)
+    run_window(controller, clock, error_every=2)
+    assert controller.limit == 5
+    assert controller.history[-1][2] == "errors"
+    for _ in range(5):
+        run_window(controller, clock, error_every=2)
+    assert controller.limit == 2
+
+
+def test_queuing_latency_decreases_limit(clock):
+    controller = AdaptiveConcurrency(initial_limit=8, clock=clock)
+    run_window(controller, clock, latency=0.05)
+    run_window(controller, clock, latency=0.5)
+    assert controller.limit == 6
+    assert controller.history[-1][2] == "latency"
+
+
+def test_growing_throughput_excuses_latency(clock):
+    controller = AdaptiveConcurrency(initial_limit=8, clock=clock)
+    run_window(controller, clock, latency=0.05, n_bytes=1000)
+    limit = controller.limit
+    run_window(controller, clock, latency=0.5, n_bytes=10000)
+    assert controller.limit == limit
+
+
+def test_fetches_without_samples_dont_adjust(clock):
+    controller = AdaptiveConcurrency(initial_limit=8, clock=clock)
+    for _ in range(3):
+        for _ in range(8):
+            assert controller.try_acquire()
+        for _ in range(8):
+            controller.release()
+    assert controller.limit == 8
+    assert controller.in_flight == 0
+    assert not controller.history
+
+
+def test_acquire_times_out_at_limit(clock):
+    controller = AdaptiveConcurrency(initial_limit=2, min_limit=2, clock=clock)
+    assert controller.acquire(timeout=0)
+    assert controller.acquire(timeout=0)
+    assert not controller.acquire(timeout=0.01)
+    controller.release()
+    assert controller.acquire(timeout=0)
@@ -0,0 +1,54 @@
+import threading
+
+import pytest
+
+from ImageSearch import ThreadFetchBackend, AsyncioFetchBackend, FetchBatch
+
+
+class FailingSearch:
+    """
+    search whose processing raises like a broken image cache
+    """
+    def __init__(self):
+        self.failed = []
+        self.done = threading.Event()
+
+    def fetch_item(self, url, batch, on_request=None):
+        return self.read_file(url), url
+
+    @staticmethod
+    def read_file(path):
+        return b"content"
+
+    @staticmethod
+    def preview_handler(url, batch):
+        return None
+
+    def process_and_enqueue(self, content, url, batch):
+        raise OSError("disk is full")
+
+    def enqueue_failure(self, url, batch):
+        self.failed.append((url, batch))
+        self.done.set()
+
+
+@pytest.fixture(params=["threads", "asyncio"])
+def backend(request):
+    if request.param == "asyncio":
+        pytest.importorskip("aiohttp")
+        backend = AsyncioFetchBackend(max_concurrency=4)
+    else:
+        backend = ThreadFetchBackend(max_workers=4)
+    yield backend
+    backend.shutdown()
+
+
+def test_raising_job_fails_its_url(backend, caplog):
+    search = FailingSearch()
+    batch = FetchBatch(local=True)
+    backend.register(search)
+    backend.submit(search, "image.png", batch)
+    assert search.done.wait(5)
+    assert search.failed == [("image.png", batch)]
+    assert "fetching image.png failed" in caplog.text
+    assert "disk is full" in caplog.text
@@ -0,0 +1,109 @@
+import time
+from email.utils import formatdate
+
+import pytest
+
+from ImageSearch import HostHealth, RetryScheduler
+
+URL = "http://example.com/image.jpg"
+OTHER_URL = "http://other.com/image.jpg"
+
+
+@pytest.fixture
+def health(clock):
+    return HostHealth(failure_threshold=3, cooldown=5, max_cooldown=300, max_trips=4, clock=clock)
+
+
+def test_breaker_trips_after_consecutive_failures(health):
+    for _ in range(2):
+        health.record_failure(URL)
+        assert health.acquire(URL)
+    health.record_failure(URL)
+    assert not health.acquire(URL)
+    assert health.report()["example.com"]["state"] == HostHealth.OPEN
+    assert health.acquire(OTHER_URL)
+
+
+def test_success_resets_consecutive_failures(health):
+    health.record_failure(URL)
+    health.record_failure(URL)
+    health.record_success(URL)
+    health.record_failure(URL)
+    assert health.acquire(URL)
+
+
+def test_half_open_lets_single_probe_through(health, clock):
+    for _ in range(3):
+        health.record_failure(URL)
+    clock.advance(5)
+    assert health.acquire(URL)
+    assert health.report()["example.com"]["state"] == HostHealth.HALF_OPEN
+    assert not health.acquire(URL)  # probe is in flight
+    health.record_success(URL)
+    assert health.report()["example.com"]["state"] == HostHealth.CLOSED
+    assert health.acquire(URL)
+
+
+def test_failed_probe_doubles_cooldown(health, clock):
+    for _ in range(3):
+        health.record_failure(URL)
+    clock.advance(5)
+    assert health.acquire(URL)
+    health.record_failure(URL)
+    assert health.delay(URL) == pytest.approx(10)
+    clock.advance(9.9)
+    assert not health.acquire(URL)
+    clock.advance(0.1)
+    assert health.acquire(URL)
+
+
+def test_host_is_dead_after_max_trips(health, clock):
+    for _ in range(3):
+        health.record_failure(URL)
+    for _ in range(3):
+        clock.advance(300)
+        assert health.acquire(URL)
+        health.record_failure(URL)
+    assert health.is_dead(URL)
+    assert health.report()["example.com"]["state"] == "dead"
+
+
+def test_retry_after_delays_host(health, clock):
+    health.record_failure(URL, retry_after=30)
+    assert health.delay(URL) == pytest.approx(30)
+    clock.advance(30)
+    assert health.acquire(URL)
+
+
+@pytest.mark.parametrize("value, expected", [("120", 120.0), (" 7 ", 7.0), ("0", 0.0),
+                                             (None, None), ("", None), ("soon", None), ("-5", None)])
+def test_parse_retry_after_seconds(value, expected):
+    assert HostHealth.parse_retry_after(value) == expected
+
+
+def test_parse_retry_after_http_date():
+    assert HostHealth.parse_retry_after(formatdate(time.time() + 60, usegmt=True)) == pytest.approx(60, abs=2)
+    assert HostHealth.parse_retry_after(formatdate(time.time() - 60, usegmt=True)) == 0.0
+
+
+def test_retries_back_off_and_run_out(health, clock):
+    scheduler = RetryScheduler(health, base_delay=1, max_delay=30, max_retries=2)
+    assert scheduler.schedule(URL)
+    assert 0.5 <= scheduler.next_delay() <= 1
+    clock.advance(1)
+    assert scheduler.pop_ready() == [(URL, None)]
+    assert scheduler.schedule(URL)
+    assert 1 <= scheduler.next_delay() <= 2
+    assert not scheduler.schedule(URL)
+
+
+def test_retry_waits_for_tripped_host(health, clock):
+    scheduler = RetryScheduler(health, base_delay=1)
+    for _ in range(3):
+        health.record_failure(URL)
+    scheduler.defer(URL)
+    assert scheduler.next_delay() == pytest.approx(5)
+    clock.advance(4)
+    assert scheduler.pop_ready() == []
+    clock.advance(1)
+    assert scheduler.pop_ready() == [(URL, None)]